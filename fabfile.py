@@ -1,14 +1,26 @@
-from fabric.contrib.files import exists, append, contains
-from fabric.contrib import files
+from fabric.contrib.files import append, contains
 from fabric.api import run, env, sudo, local, cd, settings
-from fabric.api import hide, parallel, roles, hosts, serial
+from fabric.api import hide, parallel, roles, hosts, serial, execute, runs_once
 from fabric.context_managers import shell_env
-from fabric.utils import error
+from fabric.state import default_ssh_config_path
+from fabric.utils import error, warn
+import bisect
+import functools
+import hashlib
+import inspect
+import json
+import multiprocessing.pool
 import os
+import random
+import re
+import socket
+import StringIO
+import subprocess
+import tarfile
+import threading
+import time
+import urllib2
 
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
-import libcloud.security
 from prettytable import PrettyTable
 
 
@@ -28,26 +40,53 @@ def _get_env_array(env_name, default_value, delimiter):
         return env_value.split(delimiter)
 
 
+def _to_bool(value):
+    # fab passes the task arguments as strings
+    return value in (True, 'true', 'True', 'yes', '1')
+
+
 def _get_node_name(node_name_prefix, node_id):
     return node_name_prefix + "-" + str(node_id)
 
 
+def _memoized(func):
+    """
+    Computes the value on the first call and keeps it for the lifetime
+    of the process
+    """
+    cache = {}
+
+    def func_wrapper(*args):
+        if args not in cache:
+            cache[args] = func(*args)
+        return cache[args]
+    func_wrapper.cache = cache
+    return func_wrapper
+
+
 env.forward_agent = True
 env.use_ssh_config = True
 
-os_user = os.environ["OS_USERNAME"]
-os_tenant_name = os.environ["OS_TENANT_NAME"]
-os_password = os.environ["OS_PASSWORD"]
-os_url = os.environ["OS_AUTH_URL"]+"/tokens"
 
-cluster_num_of_nodes = int(os.environ["LEADS_CLUSTER_NUM_OF_NODES"])
+# the cloud settings are read on the first use,
+# so the tasks working only over ssh do not need them
+@_memoized
+def _get_os_url():
+    return os.environ["OS_AUTH_URL"]+"/tokens"
+
+
+@_memoized
+def _get_cluster_num_of_nodes():
+    return int(os.environ["LEADS_CLUSTER_NUM_OF_NODES"])
+
+
 cluster_name = _get_env_value("LEADS_CLUSTER_NAME", "leads-m24-cluster")
 
 cluster_security_group_name = cluster_name + "_internal"
 
-# infinispan - 54200 and 55200
+# infinispan - 54200 and 55200, the bridge between the sites - 54300 and 55300
 # hadoop - 9000 and 9001 and 50070 (NameNode) and 8088 (resourcemanager)
-cluster_port_communication = ['54200', '55200', '22', '9000', '9001', '50070',
+cluster_port_communication = ['54200', '55200', '54300', '55300', '22', '9000', '9001', '50070',
                               '8088', '19888', '10020']
 
 cluster_external_access_sg_name = cluster_name + "_external_access"
@@ -65,31 +104,190 @@ node_flavor = "cloudcompute.s"
 image_name = "Ubuntu 14.04 LTS x64"
 node_metadata = {"leads_cluster_name":  cluster_name}
 
-infinispan_package_url = 'https://object-hamm5.cloudandheat.com:8080/'\
-                         'v1/AUTH_73e8d4d1688f4e1f86926d4cb897091f/infinispan/infinispan-server-7.0.1-SNAPSHOT.tgz?'\
-                         'temp_url_sig=76fcfe3e623edea4642e443ba5ff04e076395b85&'\
-                         'temp_url_expires=1419376046'
-
-hadoop_package_url = 'https://archive.apache.org/dist/hadoop/core/hadoop-2.5.2/hadoop-2.5.2.tar.gz'
+# bake_image records the image with JDK, infinispan and hadoop installed,
+# the nodes are created from it unless LEADS_CLUSTER_USE_BAKED_IMAGE=false
+cluster_image_file = _get_env_value("LEADS_CLUSTER_IMAGE_FILE", "cluster_image.json")
+use_baked_image = _to_bool(_get_env_value("LEADS_CLUSTER_USE_BAKED_IMAGE", "true"))
+bake_ssh_config_file = "bake_ssh_config"
+
+cluster_inventory_file = "cluster_inventory.json"
+
+# LEADS_CLUSTER_DATA_VOLUMES=true attaches block volumes to the nodes,
+# a node gets the volumes of all its roles, "use" is what the volume holds:
+# hdfs - the namenode, datanode and nodemanager directories, infinispan - the file stores
+use_data_volumes = _to_bool(_get_env_value("LEADS_CLUSTER_DATA_VOLUMES", "false"))
+storage_profile = {
+    'infinispan': [{'name': 'ispn', 'size_gb': 20, 'mount': '/data/ispn', 'use': 'infinispan'}],
+    'masters': [{'name': 'hdfs0', 'size_gb': 50, 'mount': '/data/hdfs0', 'use': 'hdfs'},
+                {'name': 'hdfs1', 'size_gb': 50, 'mount': '/data/hdfs1', 'use': 'hdfs'}],
+    'slaves': [{'name': 'hdfs0', 'size_gb': 50, 'mount': '/data/hdfs0', 'use': 'hdfs'},
+               {'name': 'hdfs1', 'size_gb': 50, 'mount': '/data/hdfs1', 'use': 'hdfs'}]
+}
+# role -> volumes, overwrites the roles of the default profile
+storage_profile_file = _get_env_value("LEADS_CLUSTER_STORAGE_PROFILE_FILE", "storage_profile.json")
+# no blocks reserved for root and fewer inodes, the hdfs blocks and the store files are large
+data_volume_mkfs_opts = "-m 0 -T largefile"
+data_volume_mount_opts = "defaults,noatime,nodiratime,nofail"
+data_volume_timeout_sec = 300
+
+# LEADS_CLUSTER_TRACE=trace.json records the tasks, the helpers, the remote commands
+# and the cloud calls as spans (chrome://tracing format), see show_trace_summary
+trace_file = _get_env_value("LEADS_CLUSTER_TRACE", None)
+# the tracing itself, and the functions called in tight loops or before the tracing is set up
+untraced_functions = ['_enable_tracing', '_traced', '_write_span',
+                      '_get_env_value', '_get_env_array', '_to_bool', '_memoized', '_get_node_name',
+                      'roles_host_string_based', '_vint', '_read_vint', '_benchmark_key', '_percentile']
+_trace_state = threading.local()
+
+# uploads and commands share one ssh connection per node
+# and one connection to the gateway
+ssh_multiplexing = _to_bool(_get_env_value("LEADS_CLUSTER_SSH_MULTIPLEXING", "true"))
+ssh_control_persist = _get_env_value("LEADS_CLUSTER_SSH_CONTROL_PERSIST", "10m")
+
+# create_node calls are issued through a bounded pool of workers,
+# LEADS_CLUSTER_PROVISIONING_WORKERS=1 creates nodes one by one
+cluster_provisioning_workers = int(_get_env_value("LEADS_CLUSTER_PROVISIONING_WORKERS", 10))
+cluster_provisioning_retries = int(_get_env_value("LEADS_CLUSTER_PROVISIONING_RETRIES", 3))
+cluster_provisioning_backoff_sec = 2
+
+metadata_fetch_workers = int(_get_env_value("LEADS_CLUSTER_METADATA_WORKERS", 10))
+
+# the parallel tasks run on at most LEADS_CLUSTER_POOL_SIZE nodes at a time (fab -z overrides it),
+# the ssh connections being set up through the gateway and the downloads from outside have their own limits
+parallel_pool_size = int(_get_env_value("LEADS_CLUSTER_POOL_SIZE", 20))
+if not env.pool_size:
+    env.pool_size = parallel_pool_size
+# shared with the forked workers
+resource_slots = {
+    'gateway': multiprocessing.BoundedSemaphore(int(_get_env_value("LEADS_CLUSTER_GATEWAY_CONNECTIONS", 10))),
+    'downloads': multiprocessing.BoundedSemaphore(int(_get_env_value("LEADS_CLUSTER_DOWNLOADS", 5)))
+}
+# the failed nodes are retried after 5s, 10s, 20s, ...
+parallel_retries = int(_get_env_value("LEADS_CLUSTER_PARALLEL_RETRIES", 2))
+parallel_backoff_sec = 5
+
+bring_up_timeout_sec = int(_get_env_value("LEADS_CLUSTER_BRING_UP_TIMEOUT", 1800))
+bring_up_poll_interval_sec = 5
+
+infinispan_package_url = _get_env_value(
+    "LEADS_CLUSTER_INFINISPAN_PACKAGE_URL",
+    'https://object-hamm5.cloudandheat.com:8080/'
+    'v1/AUTH_73e8d4d1688f4e1f86926d4cb897091f/infinispan/infinispan-server-7.0.1-SNAPSHOT.tgz?'
+    'temp_url_sig=76fcfe3e623edea4642e443ba5ff04e076395b85&'
+    'temp_url_expires=1419376046')
+
+hadoop_package_url = _get_env_value(
+    "LEADS_CLUSTER_HADOOP_PACKAGE_URL",
+    'https://archive.apache.org/dist/hadoop/core/hadoop-2.5.2/hadoop-2.5.2.tar.gz')
+
+# direct - every node downloads the artifacts itself
+# workstation - the artifacts are downloaded once to the workstation
+# master - the artifacts are downloaded once to the hadoop master node
+# in the last two modes, distribute_artifacts copies them to the other nodes
+artifact_distribution = _get_env_value("LEADS_CLUSTER_ARTIFACT_DISTRIBUTION", "direct")
+
+# the artifacts are kept by their sha256, on the workstation and on the nodes,
+# the least recently used are removed when the store grows over the limit
+artifact_store_dir = _get_env_value("LEADS_CLUSTER_ARTIFACT_STORE",
+                                    os.path.expanduser("~/.leads-cluster/artifacts"))
+artifact_store_max_mb = int(_get_env_value("LEADS_CLUSTER_ARTIFACT_STORE_MAX_MB", 2048))
+node_artifact_store_dir = "~/.leads-cluster/artifacts"
+
+# fingerprints of the applied installation steps, kept on each node
+node_manifest_file = "~/.leads-cluster/manifest.json"
+
+jdk_package = "openjdk-7-jdk"
+
+# the hadoop configuration is rendered locally from templates/hadoop
+hadoop_config_templates_dir = "templates/hadoop"
+hadoop_config_params = {
+    'DFS_REPLICATION': '1',
+    'DFS_MAX_XCIEVERS': '10096'
+}
+# manual tuning, the values overwrite the computed yarn and mapreduce sizing
+hadoop_sizing_file = _get_env_value("LEADS_CLUSTER_HADOOP_SIZING_FILE", "hadoop_sizing.json")
+
+# service -> roles running it, services it depends on, readiness probe
+# (port, http path or None for a tcp probe)
+hadoop_services = {
+    'namenode': {'roles': ['masters'], 'requires': [], 'probe': (9000, None)},
+    'datanode': {'roles': ['masters'], 'requires': ['namenode'], 'probe': (50010, None)},
+    'resourcemanager': {'roles': ['masters'], 'requires': [], 'probe': (8088, '/ws/v1/cluster/info')},
+    'nodemanager': {'roles': ['masters', 'slaves'], 'requires': ['resourcemanager'], 'probe': (8042, None)}
+}
+hadoop_service_timeout_sec = int(_get_env_value("LEADS_CLUSTER_HADOOP_SERVICE_TIMEOUT", 120))
+
+infinispan_ports = {'hotrod': 11222, 'memcached': 11211, 'jgroups': 55200, 'management': 9990}
+infinispan_cache_container = "26001"
+# the node ids per site (microcloud), e.g. LEADS_CLUSTER_SITES="A=0,1;B=2,3",
+# each site runs its own infinispan cluster, the site masters back up
+# the distributed caches to the other sites, the nodes not listed are in the first site
+cluster_sites = [(site.partition("=")[0], site.partition("=")[2].split(","))
+                 for site in _get_env_array("LEADS_CLUSTER_SITES", ["A="], ";")]
+xsite_backup_strategy = "ASYNC"
+xsite_backup_timeout_ms = 10000
+# the probes reach the nodes through ssh tunnels,
+# set to false, if the workstation can reach the private ips
+infinispan_probe_via_ssh = _to_bool(_get_env_value("LEADS_CLUSTER_PROBE_VIA_SSH", "true"))
+infinispan_probe_workers = int(_get_env_value("LEADS_CLUSTER_PROBE_WORKERS", 20))
+ssh_tunnel_timeout_sec = 30
+infinispan_mgmt_user = _get_env_value("LEADS_CLUSTER_ISPN_MGMT_USER", None)
+infinispan_mgmt_password = _get_env_value("LEADS_CLUSTER_ISPN_MGMT_PASSWORD", None)
+# the cache and JVM statistics sampled by monitor_infinispan, one json array per line
+infinispan_stats_file = _get_env_value("LEADS_CLUSTER_ISPN_STATS_FILE", "infinispan_stats.jsonl")
+infinispan_cache_stats = ['hits', 'misses', 'stores', 'evictions', 'number-of-entries',
+                          'cache-loader-loads', 'cache-loader-misses', 'cache-loader-stores',
+                          'average-read-time', 'average-write-time']
+infinispan_jvm_stats = ['heap_used_mb', 'heap_max_mb', 'gc_count', 'gc_time_ms']
+infinispan_config_template = "templates/infinispan-config_template.xml"
+# the file stores of WebPage and Link, without a volume for infinispan
+infinispan_store_path = "/hdfs"
+infinispan_jvm_template = "templates/infinispan-standalone_template.conf"
+# manual tuning, the values overwrite the computed sizing profile
+infinispan_sizing_file = _get_env_value("LEADS_CLUSTER_ISPN_SIZING_FILE", "infinispan_sizing.json")
+# cache -> endpoint the benchmark uses, the memcached connector serves memcachedCache
+benchmark_caches = {'default': 'hotrod', 'WebPage': 'hotrod', 'memcachedCache': 'memcached'}
+benchmark_results_dir = _get_env_value("LEADS_CLUSTER_BENCHMARK_DIR", "benchmarks")
+# a metric worse than the baseline by more than this is reported as a regression
+hadoop_benchmark_regression_pct = float(_get_env_value("LEADS_CLUSTER_BENCHMARK_REGRESSION_PCT", 10))
 
 hadoop_master_node_id = _get_env_value("LEADS_CLUSTER_HADOOP_MASTER_NODE_ID", 0)
 hadoop_master_node = _get_node_name(node_name_prefix, str(hadoop_master_node_id))
 hadoop_slave_node_ids = _get_env_array("LEADS_CLUSTER_HADOOP_SLAVE_NODE_IDS", [1], ",")
 hadoop_slave_nodes = [_get_node_name(node_name_prefix, s) for s in hadoop_slave_node_ids]
 
+
+def _get_scaled_out_slaves():
+    """
+    The nodes added by scale_out are hadoop slaves, they are known only
+    from their metadata in the inventory
+    """
+    if not os.path.exists(cluster_inventory_file):
+        return []
+    with open(cluster_inventory_file, 'r') as f:
+        nodes = json.load(f)['nodes']
+    return [n['name'] for n in nodes if n['metadata'].get('leads_cluster_hadoop_role') == 'slaves']
+
+
 env.roledefs = {
     'masters': [hadoop_master_node],
-    'slaves': hadoop_slave_nodes
+    'slaves': hadoop_slave_nodes + [n for n in _get_scaled_out_slaves() if n not in hadoop_slave_nodes]
 }
 
 
-Driver = get_driver(Provider.OPENSTACK)
-os_conn = Driver(os_user, os_password,
-                 ex_tenant_name=os_tenant_name,
-                 ex_force_auth_url=os_url,
-                 ex_force_auth_version='2.0_password')
+@_memoized
+def _get_os_conn():
+    from libcloud.compute.types import Provider
+    from libcloud.compute.providers import get_driver
+    import libcloud.security
+
+    libcloud.security.VERIFY_SSL_CERT = False
 
-libcloud.security.VERIFY_SSL_CERT = False
+    Driver = get_driver(Provider.OPENSTACK)
+    return Driver(os.environ["OS_USERNAME"], os.environ["OS_PASSWORD"],
+                  ex_tenant_name=os.environ["OS_TENANT_NAME"],
+                  ex_force_auth_url=_get_os_url(),
+                  ex_force_auth_version='2.0_password')
 
 
 # fabric roles works only on env.host
@@ -108,27 +306,638 @@ def roles_host_string_based(*args):
 
 
 def create_cluster():
+    nodes = _create_cluster_nodes()
+
+    n_and_ips = _get_os_conn().wait_until_running(nodes)
+    _generate_cluster_files(n_and_ips)
+
+
+def _create_cluster_nodes():
+    # create VMs
+    node_names = [_get_node_name(node_name_prefix, i) for i in range(0, _get_cluster_num_of_nodes())]
+    return _provision_nodes(_get_os_conn(), node_names, _get_cluster_sec_groups())
+
+
+def _get_cluster_sec_groups():
     external_sec_group = _create_external_access_sg(cluster_external_access_sg_name)
     internal_sec_group = _create_cluster_internal_sg(cluster_security_group_name)
+    return [external_sec_group, internal_sec_group]
 
-    sec_groups = [external_sec_group, internal_sec_group]
-    # create a VM
-    nodes = []
-    for i in range(0, cluster_num_of_nodes):
-        node_name = _get_node_name(node_name_prefix, i)
-        n = _create_instance(cluster_name, node_name, sec_groups)
-        nodes.append(n)
 
-    n_and_ips = os_conn.wait_until_running(nodes)
+def _generate_cluster_files(n_and_ips):
     _generate_ssh_config(n_and_ips)
     _generate_host_file(n_and_ips)
     _generate_private_ips_file(n_and_ips)
+    _generate_inventory_file(n_and_ips)
+
+
+def bring_up_cluster():
+    """
+    Creates the cluster and installs infinispan and hadoop on every node
+    as soon as the node answers on ssh, without waiting for the others.
+    """
+    from libcloud.compute.types import NodeState
+
+    start = time.time()
+    names = [n.name for n in _create_cluster_nodes()]
+
+    env.use_ssh_config = True
+    env.ssh_config_path = "./cluster_ssh_config"
+
+    timings = dict((name, {}) for name in names)
+    ready_nodes = {}
+    ssh_probes = {}
+    prepare_stages = {}
+    configure_stages = {}
+    failures = {}
+    retry_at = {}
+    volumes_attached = not use_data_volumes
+    # the copied artifacts are there before the first installation starts
+    artifacts_distributed = artifact_distribution == "direct"
+
+    probe_pool = multiprocessing.pool.ThreadPool(max(1, min(cluster_provisioning_workers, len(names))))
+    try:
+        while len([name for name in names if 'configured' in timings[name]]) < len(names):
+            if time.time() - start > bring_up_timeout_sec:
+                error("Cluster is not ready after {0} seconds!".format(bring_up_timeout_sec))
+
+            # a single listing gives us the state of all the nodes
+            new_nodes = []
+            for n in _get_os_conn().list_nodes():
+                if n.name not in timings or n.name in ready_nodes:
+                    continue
+                if n.state == NodeState.ERROR:
+                    error("Node {0} is in the error state!".format(n.name))
+                if n.state == NodeState.RUNNING and n.private_ips:
+                    new_nodes.append(n)
+            if new_nodes:
+                for n in new_nodes:
+                    ready_nodes[n.name] = n
+                    timings[n.name]['ip'] = time.time() - start
+                n_and_ips = [(ready_nodes[name], ready_nodes[name].private_ips)
+                             for name in names if name in ready_nodes]
+                _generate_cluster_files(n_and_ips)
+                # fabric caches the parsed ssh config
+                env.pop('_ssh_config', None)
+
+            # the configuration mounts the volumes, they are recorded in the inventory
+            if not volumes_attached and len(ready_nodes) == len(names):
+                _attach_data_volumes(_get_os_conn(), [ready_nodes[name] for name in names])
+                _generate_cluster_files([(ready_nodes[name], ready_nodes[name].private_ips) for name in names])
+                volumes_attached = True
+
+            # at most parallel_pool_size nodes are installed or configured at a time
+            running = len([p for p in prepare_stages.values() + configure_stages.values() if p.exitcode is None])
+            for name in ready_nodes:
+                if name not in ssh_probes:
+                    ssh_probes[name] = probe_pool.apply_async(_ssh_responds, (name,))
+                elif name not in prepare_stages and ssh_probes[name].ready():
+                    if not ssh_probes[name].get():
+                        del ssh_probes[name]
+                    elif artifacts_distributed and running < parallel_pool_size and \
+                            time.time() >= retry_at.get(name, 0):
+                        timings[name].setdefault('ssh', time.time() - start)
+                        prepare_stages[name] = _start_bring_up_stage(_bring_up_prepare_node, name)
+                        running += 1
+
+            if not artifacts_distributed and len(names) == len(
+                    [name for name in names if name in ssh_probes and ssh_probes[name].ready()]):
+                distribute_artifacts()
+                artifacts_distributed = True
+
+            for name, p in prepare_stages.items():
+                if p.exitcode is None or name in configure_stages:
+                    continue
+                if p.exitcode != 0:
+                    _retry_bring_up_stage(name, prepare_stages, failures, retry_at, "Installation")
+                    continue
+                timings[name].setdefault('installed', time.time() - start)
+                # the configuration needs private ips of all the nodes
+                if volumes_attached and len(ready_nodes) == len(names) and running < parallel_pool_size and \
+                        time.time() >= retry_at.get(name, 0):
+                    configure_stages[name] = _start_bring_up_stage(_bring_up_configure_node, name)
+                    running += 1
+
+            for name, p in configure_stages.items():
+                if p.exitcode is not None and 'configured' not in timings[name]:
+                    if p.exitcode != 0:
+                        _retry_bring_up_stage(name, configure_stages, failures, retry_at, "Configuration")
+                        continue
+                    timings[name]['configured'] = time.time() - start
+
+            time.sleep(bring_up_poll_interval_sec)
+    finally:
+        # on errors the stages still running would outlive the task
+        for p in prepare_stages.values() + configure_stages.values():
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        probe_pool.close()
+        probe_pool.join()
+
+    _print_bring_up_report(names, timings, failures)
+
+
+def _ssh_responds(node_name):
+    with open(os.devnull, 'w') as devnull, resource_slots['gateway']:
+        return subprocess.call(["ssh", "-F", env.ssh_config_path,
+                                "-o", "BatchMode=yes",
+                                "-o", "ConnectTimeout=10",
+                                "-o", "StrictHostKeyChecking=no",
+                                node_name, "true"],
+                               stdout=devnull, stderr=devnull) == 0
+
+
+def _retry_bring_up_stage(node_name, stages, failures, retry_at, stage_name):
+    failures[node_name] = failures.get(node_name, 0) + 1
+    if failures[node_name] > parallel_retries:
+        error("{0} failed on {1}!".format(stage_name, node_name))
+    warn("{0} failed on {1}, retrying".format(stage_name, node_name))
+    del stages[node_name]
+    retry_at[node_name] = time.time() + parallel_backoff_sec * 2 ** (failures[node_name] - 1)
+
+
+def _start_bring_up_stage(stage, node_name):
+    p = multiprocessing.Process(target=execute, args=(stage,), kwargs={'hosts': [node_name]})
+    p.start()
+    return p
+
+
+def _bring_up_prepare_node():
+    _apply_steps(_get_infinispan_package_steps() + _get_hadoop_package_steps())
+
+
+def _bring_up_configure_node():
+    _apply_steps(_get_infinispan_config_steps() + _get_hadoop_config_steps())
+
+
+def _print_bring_up_report(names, timings, failures):
+    x = PrettyTable(["Node name", "IP [s]", "SSH [s]", "Installed [s]", "Configured [s]", "Retries"])
+    for name in names:
+        t = timings[name]
+        x.add_row([name] + ["{0:.1f}".format(t[k]) for k in ('ip', 'ssh', 'installed', 'configured')] +
+                  [failures.get(name, 0)])
+    print x
+
+
+@runs_once
+def schedule(task_name, *args, **kwargs):
+    """
+    Runs a task on the cluster nodes (or on the -H hosts) in parallel with
+    bounded concurrency, retries the failed nodes and prints per node the
+    result and the latency, usage:
+    fab schedule:install_infinispan[,force=true] --ssh-config-path=cluster_ssh_config
+    """
+    task = globals().get(task_name)
+    if task_name.startswith("_") or not callable(task):
+        error("No task {0}!".format(task_name))
+    _execute_bounded(task, env.all_hosts or [n['name'] for n in _get_inventory_nodes()], *args, **kwargs)
+
+
+def _execute_bounded(task, hosts, *args, **kwargs):
+    """
+    Runs the task on the hosts in parallel, at most env.pool_size at a time,
+    retries the failed hosts with exponential backoff and prints the summary.
+    Returns the results by host, fails if a host still fails after the retries.
+    """
+    start = time.time()
+    summary = {}
+    pending = list(hosts)
+    for attempt in range(parallel_retries + 1):
+        if attempt:
+            delay = parallel_backoff_sec * 2 ** (attempt - 1)
+            warn("{0} failed, retrying in {1}s".format(", ".join(sorted(pending)), delay))
+            time.sleep(delay)
+        with settings(parallel=True):
+            outcomes = execute(_timed(task), *args, hosts=pending, **kwargs)
+        for host, outcome in outcomes.items():
+            summary[host] = dict(outcome, attempts=attempt + 1, total=outcome['end'] - start)
+        pending = [host for host in pending if not summary[host]['ok']]
+        if not pending:
+            break
+
+    _print_schedule_report(summary)
+    if pending:
+        error("{0} failed on {1} after {2} attempts!".format(
+            task.__name__, ", ".join(sorted(pending)), parallel_retries + 1))
+    return dict((host, s['result']) for host, s in summary.items())
+
+
+def _timed(task):
+    """
+    The task returning its result and latency, a failure (also abort) is
+    returned to the scheduler instead of stopping the other hosts
+    """
+    @functools.wraps(task)
+    def timed_task(*args, **kwargs):
+        start = time.time()
+        outcome = {'ok': True, 'result': None, 'error': None}
+        try:
+            outcome['result'] = task(*args, **kwargs)
+        except (Exception, SystemExit) as e:
+            outcome.update(ok=False, error=getattr(e, 'message', None) or str(e) or e.__class__.__name__)
+        outcome.update(seconds=time.time() - start, end=time.time())
+        return outcome
+    return timed_task
+
+
+def _print_schedule_report(summary):
+    x = PrettyTable(["Host", "Result", "Attempts", "Last attempt [s]", "Total [s]"])
+    x.align["Result"] = "l"
+    for host in sorted(summary):
+        s = summary[host]
+        x.add_row([host, "ok" if s['ok'] else "failed: " + str(s['error'])[:60], s['attempts'],
+                   "{0:.1f}".format(s['seconds']), "{0:.1f}".format(s['total'])])
+    print x
+    latencies = sorted(s['total'] for s in summary.values())
+    print "{0}/{1} hosts ok, latency p50 {2:.1f}s, p95 {3:.1f}s, max {4:.1f}s".format(
+        len([s for s in summary.values() if s['ok']]), len(summary),
+        _percentile(latencies, 50), _percentile(latencies, 95), latencies[-1])
+
+
+def scale_out(n, timeout=1800):
+    """
+    Adds n nodes running infinispan and the hadoop slave services, the
+    running nodes only get the new hosts and configuration, usage:
+    fab scale_out:2 --ssh-config-path=cluster_ssh_config
+    """
+    start = time.time()
+    deadline = start + float(timeout)
+    existing = [node['name'] for node in _get_inventory_nodes()]
+    next_id = max(_get_node_id(name) for name in existing) + 1
+    names = [_get_node_name(node_name_prefix, i) for i in range(next_id, next_id + int(n))]
+    _pin_infinispan_sizing()
+
+    conn = _get_os_conn()
+    nodes = _provision_nodes(conn, names, _get_cluster_sec_groups(),
+                             metadata=dict(node_metadata, leads_cluster_hadoop_role='slaves'))
+    conn.wait_until_running(nodes)
+    env.roledefs['slaves'].extend(names)
+    if use_data_volumes:
+        _attach_data_volumes(conn, nodes)
+    _refresh_inventory()
+    # fabric caches the parsed ssh config
+    env.pop('_ssh_config', None)
+
+    pending = list(names)
+    while pending:
+        if time.time() > deadline:
+            error("No ssh on {0}!".format(", ".join(pending)))
+        pending = [name for name in pending if not _ssh_responds(name)]
+        if pending:
+            time.sleep(bring_up_poll_interval_sec)
+
+    if artifact_distribution != "direct":
+        distribute_artifacts()
+    _execute_bounded(_bring_up_prepare_node, names)
+    # the running members only get the config files, they are not restarted
+    _execute_bounded(_bring_up_configure_node, existing + names)
+    _execute_bounded(start_infinispan_service, names)
+
+    nodes = _get_inventory_nodes('infinispan')
+    endpoints, tunnels = _open_infinispan_endpoints(nodes)
+    try:
+        timings = _wait_for_infinispan_view(endpoints, _get_infinispan_view_sizes(nodes), deadline - time.time())
+        not_formed = [name for name, t in timings.items() if t.get('formed') is None]
+        if not_formed:
+            error("Cluster view not formed on {0}!".format(", ".join(sorted(not_formed))))
+        for name in _get_site_members([n for n in nodes if n['name'] in names]).values():
+            _wait_for_infinispan_rebalance(endpoints[name]['management'],
+                                           _get_infinispan_distributed_caches(), deadline - time.time())
+    finally:
+        _close_ssh_tunnels(tunnels)
+
+    _run_hadoop_tiers("start", _get_hadoop_service_tiers(hadoop_services), hosts=names)
+    print "Added {0} in {1:.1f}s".format(", ".join(names), time.time() - start)
+
+
+def scale_in(names, timeout=1800):
+    """
+    Removes the nodes (separated with ;): decommissions them in HDFS and YARN,
+    stops infinispan at most owners-1 nodes at a time waiting for the state
+    transfer, then deletes the VMs, usage:
+    fab scale_in:"leads-m24-cluster-node-2;leads-m24-cluster-node-3" --ssh-config-path=cluster_ssh_config
+    """
+    start = time.time()
+    deadline = start + float(timeout)
+    names = names.split(";")
+    inventory = _get_inventory()
+    unknown = [name for name in names if name not in inventory['by_name']]
+    if unknown:
+        error("No node is running with name {0}!".format(", ".join(unknown)))
+    if hadoop_master_node in names:
+        error("The hadoop master {0} cannot be removed!".format(hadoop_master_node))
+    remaining = [node for node in inventory['nodes'] if node['name'] not in names]
+    if not remaining:
+        error("At least one node must stay!")
+    hadoop_nodes = [name for name in names if name in env.roledefs['slaves']]
+    _pin_infinispan_sizing()
+
+    if hadoop_nodes:
+        execute(_decommission_hadoop_nodes, hadoop_nodes, deadline, hosts=[hadoop_master_node])
+        _run_hadoop_tiers("stop", list(reversed(_get_hadoop_service_tiers(hadoop_services))),
+                          hosts=hadoop_nodes)
+    _leave_infinispan_cluster(names, remaining, deadline)
+
+    conn = _get_os_conn()
+    for node in conn.list_nodes():
+        if node.name in names:
+            conn.destroy_node(node)
+    if use_data_volumes:
+        _delete_data_volumes(conn, names, deadline)
+    for name in hadoop_nodes:
+        env.roledefs['slaves'].remove(name)
+    _refresh_inventory(excluded=names)
+    env.pop('_ssh_config', None)
+
+    _execute_bounded(_bring_up_configure_node, [node['name'] for node in remaining])
+    if hadoop_nodes:
+        execute(_set_hadoop_excludes, [], hosts=[hadoop_master_node])
+    print "Removed {0} in {1:.1f}s".format(", ".join(names), time.time() - start)
+
+
+def create_volumes():
+    """
+    Creates and attaches the block volumes of the storage profile to every
+    node (LEADS_CLUSTER_DATA_VOLUMES=true), the existing ones are kept,
+    the next install formats and mounts them
+    """
+    if not use_data_volumes:
+        error("Set LEADS_CLUSTER_DATA_VOLUMES=true to use the data volumes!")
+    conn = _get_os_conn()
+    names = [n['name'] for n in _get_inventory_nodes()]
+    _attach_data_volumes(conn, [n for n in conn.list_nodes() if n.name in names])
+    _refresh_inventory()
+
+
+def _attach_data_volumes(conn, nodes):
+    """
+    Creates the missing volumes of the nodes and attaches the detached ones
+    with a bounded pool of workers
+    """
+    existing = dict((v.name, v) for v in conn.list_volumes())
+    jobs = [(node, volume) for node in nodes for volume in _get_storage_profile(_get_node_roles(node.name))]
+
+    def attach(job):
+        node, volume = job
+        cloud_volume = existing.get(node.name + "-" + volume['name'])
+        if cloud_volume is None:
+            cloud_volume = conn.create_volume(volume['size_gb'], node.name + "-" + volume['name'])
+        if cloud_volume.extra.get('attachments'):
+            return None
+        cloud_volume = _wait_for_volume(conn, cloud_volume, 'available', time.time() + data_volume_timeout_sec)
+        conn.attach_volume(node, cloud_volume)
+        return cloud_volume
+
+    if not jobs:
+        return
+    pool = multiprocessing.pool.ThreadPool(max(1, min(cluster_provisioning_workers, len(jobs))))
+    try:
+        for cloud_volume in pool.map(attach, jobs):
+            if cloud_volume is not None:
+                print "Volume {0} ({1}) attached".format(cloud_volume.name, cloud_volume.id)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _delete_data_volumes(conn, node_names, deadline):
+    """
+    Deletes the volumes of the deleted nodes, as soon as they are detached
+    """
+    prefixes = tuple(name + "-" for name in node_names)
+    for cloud_volume in conn.list_volumes():
+        if cloud_volume.name and cloud_volume.name.startswith(prefixes):
+            conn.destroy_volume(_wait_for_volume(conn, cloud_volume, 'available', deadline))
+            print "Volume {0} deleted".format(cloud_volume.name)
+
+
+def _wait_for_volume(conn, cloud_volume, state, deadline):
+    while cloud_volume.extra.get('state') != state:
+        if cloud_volume.extra.get('state') == 'error' or time.time() > deadline:
+            error("Volume {0} is not {1}, state: {2}".format(cloud_volume.name, state,
+                                                             cloud_volume.extra.get('state')))
+        time.sleep(2)
+        cloud_volume = conn.ex_get_volume(cloud_volume.id)
+    return cloud_volume
+
+
+def _get_storage_profile(roles):
+    """
+    The volumes for a node with the roles, each volume once
+    """
+    profile = dict(storage_profile)
+    profile.update(_read_sizing_overrides(storage_profile_file))
+    volumes = []
+    for role in roles:
+        for volume in profile.get(role, []):
+            if volume['name'] not in [v['name'] for v in volumes]:
+                volumes.append(volume)
+    return volumes
+
+
+def _get_node_volumes(node_name, cloud_volumes):
+    """
+    The volumes of the storage profile created for the node, with their ids
+    """
+    by_name = dict((v.name, v) for v in cloud_volumes)
+    return [dict(volume, id=by_name[node_name + "-" + volume['name']].id)
+            for volume in _get_storage_profile(_get_node_roles(node_name))
+            if node_name + "-" + volume['name'] in by_name]
+
+
+def _get_data_volume_steps():
+    volumes = _get_inventory()['by_name'][env.host]['volumes']
+    if not volumes:
+        return []
+    return [('data_volumes', _fingerprint(volumes, data_volume_mkfs_opts, data_volume_mount_opts),
+             lambda: _mount_data_volumes(volumes))]
+
+
+def _mount_data_volumes(volumes):
+    """
+    Formats the empty volumes and mounts them through /etc/fstab. The devices
+    are found by the volume ids, their names depend on the attachment order.
+    """
+    for volume in volumes:
+        # the virtio serial is the beginning of the volume id
+        device = "/dev/disk/by-id/virtio-" + volume['id'][:20]
+        sudo("for i in $(seq {0}); do test -b {1} && break; sleep 1; done; test -b {1}".format(
+            data_volume_timeout_sec, device))
+        sudo("blkid {0} || mkfs.ext4 -q {1} {0}".format(device, data_volume_mkfs_opts))
+        sudo("mkdir -p {0} && (grep -q ' {0} ' /etc/fstab || "
+             "echo \"UUID=$(blkid -s UUID -o value {1}) {0} ext4 {2} 0 2\" >> /etc/fstab) && "
+             "(mountpoint -q {0} || mount {0}) && chown $SUDO_USER: {0}".format(
+                 volume['mount'], device, data_volume_mount_opts))
+
+
+def _pin_infinispan_sizing():
+    """
+    Keeps the segments and the owners of the running cluster in the sizing
+    overrides, the members must agree on them whatever the number of nodes
+    """
+    overrides = _read_sizing_overrides(infinispan_sizing_file)
+    missing = [key for key in ('segments', 'owners') if key not in overrides]
+    if not missing:
+        return
+    sizing = _get_infinispan_sizing()
+    overrides.update((key, sizing[key]) for key in missing)
+    with open(infinispan_sizing_file, "w") as f:
+        json.dump(overrides, f, indent=2, sort_keys=True)
+    _get_infinispan_sizing.cache.clear()
+    print "Pinned {0} in {1}".format(", ".join("{0}={1}".format(key, overrides[key]) for key in missing),
+                                     infinispan_sizing_file)
+
+
+def _decommission_hadoop_nodes(names, deadline):
+    """
+    Puts the nodes on the HDFS and YARN exclude lists and waits until their
+    datanodes are decommissioned, their blocks are copied to the other nodes
+    """
+    _set_hadoop_excludes(names)
+    datanodes = [get_node_private_ip(name) for name in names
+                 if any(name in env.roledefs[r] for r in hadoop_services['datanode']['roles'])]
+    while datanodes:
+        with hide('stdout'):
+            report = _execute_hadoop_command("$HADOOP_PREFIX/bin/hdfs dfsadmin -report")
+        statuses = dict(re.findall(r"Name: ([\d.]+):\d+.*?Decommission Status : ([\w ]+)", report, re.S))
+        datanodes = [ip for ip in datanodes if statuses.get(ip, "Decommissioned").strip() != "Decommissioned"]
+        if datanodes:
+            if time.time() > deadline:
+                error("Datanodes {0} are not decommissioned in time!".format(", ".join(datanodes)))
+            time.sleep(10)
+
+
+def _set_hadoop_excludes(names):
+    hadoop_home = _get_hadoop_home()
+    hosts = " ".join("'" + h + "'" for h in names + [get_node_private_ip(name) for name in names])
+    run("printf '%s\\n' {0} | tee {1}/dfs.exclude > {1}/yarn.exclude".format(hosts, hadoop_home))
+    _execute_hadoop_command("$HADOOP_PREFIX/bin/hdfs dfsadmin -refreshNodes")
+    _execute_hadoop_command("$HADOOP_PREFIX/bin/yarn rmadmin -refreshNodes")
+
+
+def _leave_infinispan_cluster(names, remaining, deadline):
+    """
+    Stops infinispan at most owners-1 nodes at a time, each time waits until
+    the remaining nodes see them gone and the state transfer is over
+    """
+    caches = _get_infinispan_distributed_caches()
+    batch_size = max(1, _get_infinispan_sizing()['owners'] - 1)
+    by_name = _get_inventory()['by_name']
+    site_members = _get_site_members(remaining)
+    endpoints, tunnels = _open_infinispan_endpoints(remaining)
+    try:
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i + batch_size]
+            execute(stop_infinispan_service, hosts=batch)
+            view_sizes = _get_infinispan_view_sizes(remaining + [by_name[name] for name in names[i + batch_size:]])
+            # each site is a cluster of its own, a remaining member watches its site
+            for site in sorted(set(by_name[name]['site'] for name in batch)):
+                if site not in site_members:
+                    continue
+                management_address = endpoints[site_members[site]]['management']
+                while not 0 < _get_infinispan_view_size(management_address) <= view_sizes[site_members[site]]:
+                    if time.time() > deadline:
+                        error("{0} still in the cluster view!".format(", ".join(batch)))
+                    time.sleep(2)
+                _wait_for_infinispan_rebalance(management_address, caches, deadline - time.time())
+            print "{0} left the infinispan cluster".format(", ".join(batch))
+    finally:
+        _close_ssh_tunnels(tunnels)
+
+
+def bake_image(name=None, timeout=1800):
+    """
+    Installs JDK, infinispan and hadoop on a temporary node and snapshots it,
+    the nodes created afterwards boot from the image and run only the
+    configuration steps, usage:
+    fab bake_image[:name=leads-image]
+    """
+    start = time.time()
+    name = name or "{0}-image-{1}".format(cluster_name, time.strftime("%Y%m%d%H%M%S"))
+    image = _bake_image(_get_os_conn(), name, _get_cluster_sec_groups(), _prepare_bake_node, float(timeout))
+    print "Image {0} ({1}) baked in {2:.1f}s, recorded in {3}".format(
+        image.name, image.id, time.time() - start, cluster_image_file)
+
+
+def _bake_image(conn, name, sec_groups, prepare_node, timeout):
+    """
+    Boots the bake node from the base image, prepares it with
+    prepare_node(node name, ip), snapshots it, waits until the image
+    is active and records it; the bake node is always deleted
+    """
+    deadline = time.time() + timeout
+    # without the cluster tag, the bake node is not a member of the cluster
+    node = _provision_nodes(conn, [cluster_name + "-bake"], sec_groups,
+                            metadata={"leads_cluster_bake": cluster_name}, image=image_name)[0]
+    try:
+        node = conn.wait_until_running([node], timeout=max(1, deadline - time.time()),
+                                       ssh_interface='private_ips')[0][0]
+        prepare_node(node.name, node.private_ips[0])
+        image = conn.create_image(node, name)
+        while image.extra.get('status') != 'ACTIVE':
+            if image.extra.get('status') == 'ERROR' or time.time() > deadline:
+                error("Image {0} is not active, status: {1}".format(name, image.extra.get('status')))
+            time.sleep(bring_up_poll_interval_sec)
+            image = conn.get_image(image.id)
+    finally:
+        conn.destroy_node(node)
+
+    with open(cluster_image_file, "w") as f:
+        json.dump({'name': image.name, 'id': image.id, 'base_image': image_name,
+                   'packages': _get_baked_packages()}, f, indent=2, sort_keys=True)
+    _get_node_image_name.cache.clear()
+    return image
+
+
+def _prepare_bake_node(node_name, ip):
+    _write_ssh_config(bake_ssh_config_file, [(node_name, ip)], ssh_multiplexing)
+    env.use_ssh_config = True
+    env.ssh_config_path = bake_ssh_config_file
+    env.pop('_ssh_config', None)
+    while not _ssh_responds(node_name):
+        time.sleep(bring_up_poll_interval_sec)
+    execute(_bake_node, hosts=[node_name])
+
+
+def _bake_node():
+    """
+    Installs the packages, the manifest in the image tells the nodes
+    booted from it to skip these steps
+    """
+    _apply_steps(_get_infinispan_package_steps() +
+                 [('hadoop_package', _get_hadoop_package_fingerprint(), _install_hadoop_artifact)])
+    # the extracted packages are kept, the downloaded archives only grow the image
+    run("cd {0} && ls -1 | grep -v '^urls$' | xargs -r rm -f && find ~ -maxdepth 1 -xtype l -delete".format(
+        node_artifact_store_dir))
+    sudo("apt-get clean && sync")
+
+
+def _get_baked_packages():
+    return {'jdk': _fingerprint(jdk_package),
+            'infinispan_package': _get_infinispan_package_fingerprint(),
+            'hadoop_package': _get_hadoop_package_fingerprint()}
+
+
+@_memoized
+def _get_node_image_name():
+    """
+    The image recorded by bake_image, if there is one, else the base image
+    """
+    if not use_baked_image or not os.path.exists(cluster_image_file):
+        return image_name
+    with open(cluster_image_file, "r") as f:
+        baked = json.load(f)
+    if baked['packages'] != _get_baked_packages():
+        warn("The packages changed since {0} was baked, the nodes will install them, "
+             "run bake_image again".format(baked['name']))
+    return baked['name']
 
 
 def _create_external_access_sg(sec_group_name):
     sg = _find_sg_by_name(sec_group_name)
     if not sg:
-        sec_group = os_conn.ex_create_security_group(
+        sec_group = _get_os_conn().ex_create_security_group(
             name=sec_group_name,
             description="External access to leads project demo cluster"
             )
@@ -140,13 +949,13 @@ def _create_external_access_sg(sec_group_name):
 
 
 def _find_sg_by_name(sec_group_name):
-    all_sec_groups = os_conn.ex_list_security_groups()
+    all_sec_groups = _get_os_conn().ex_list_security_groups()
     return [s for s in all_sec_groups if s.name == sec_group_name]
 
 
 def _create_external_sg_rules(sec_group, ports):
     for port in ports:
-        os_conn.ex_create_security_group_rule(
+        _get_os_conn().ex_create_security_group_rule(
             sec_group,
             ip_protocol='tcp',
             from_port=port,
@@ -158,19 +967,26 @@ def _create_external_sg_rules(sec_group, ports):
 def _create_cluster_internal_sg(sec_group_name):
     sg = _find_sg_by_name(sec_group_name)
     if not sg:
-        sec_group = os_conn.ex_create_security_group(
+        sec_group = _get_os_conn().ex_create_security_group(
             name=sec_group_name,
             description="Internal for leads project demo cluster")
         _create_security_group_rules(sec_group, cluster_port_communication)
     else:
         assert len(sg) == 1
         sec_group = sg[0]
+        # the group may predate ports added to cluster_port_communication
+        existing = set(str(rule.from_port) for rule in sec_group.rules
+                       if rule.ip_protocol == 'tcp' and rule.group and rule.from_port == rule.to_port)
+        missing = [port for port in cluster_port_communication if port not in existing]
+        if missing:
+            print "Adding ports {0} to {1}".format(", ".join(missing), sec_group_name)
+            _create_security_group_rules(sec_group, missing)
     return sec_group
 
 
 def _create_security_group_rules(sec_group, ports):
     for port in ports:
-        os_conn.ex_create_security_group_rule(
+        _get_os_conn().ex_create_security_group_rule(
             sec_group,
             ip_protocol='tcp',
             from_port=port,
@@ -179,52 +995,96 @@ def _create_security_group_rules(sec_group, ports):
             )
 
 
-def _create_instance(cluster_name, node_name, sec_groups):
-    """
+def _provision_nodes(conn, node_names, sec_groups,
+                     workers=cluster_provisioning_workers,
+                     retries=cluster_provisioning_retries,
+                     metadata=node_metadata, image=None):
     """
-    existing_node = _find_node_by_name(cluster_name, node_name)
+    Creates the missing nodes with a bounded pool of workers.
 
-    if not existing_node:
-        img = _get_image(image_name)
-        size = _get_flavor(node_flavor)
-
-        primary_ssh_key = _get_primary_ssh_key(cluster_primary_ssh_key)
-        args = {'name': node_name, 'image': img, 'size': size,
-                'ex_keyname': primary_ssh_key.name, 'ex_security_groups': sec_groups,
-                'ex_metadata': node_metadata}
-        if cluster_additinal_ssh_keys:
-            sec_ssh_key_cloud_init = _get_cloud_init_with_sec_ssh_keys(cluster_additinal_ssh_keys)
-            args['ex_userdata'] = sec_ssh_key_cloud_init
-            args['ex_config_drive'] = True
-        node = os_conn.create_node(**args)
-    else:
-        node = existing_node[0]
-    return node
-
-
-def _find_node_by_name(cluser_name, node_name):
-    all_nodes = os_conn.list_nodes()
-    node = [n for n in all_nodes if n.name == node_name]
-    assert len(node) == 1 or len(node) == 0
-    return node
-
-
-def _get_image(img_name):
-    all_images = os_conn.list_images()
+    The nodes, the image, the flavor and the key are looked up once,
+    the workers only issue create_node calls.
+    """
+    snapshot = _get_inventory_snapshot(conn, node_names, image or _get_node_image_name())
+    create_args = _get_create_node_args(snapshot, sec_groups, metadata)
+
+    missing = [n for n in node_names if n not in snapshot['nodes']]
+    created = {}
+    if missing:
+        pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(missing))))
+        try:
+            new_nodes = pool.map(
+                lambda name: _create_instance(conn, name, create_args, retries),
+                missing)
+        finally:
+            pool.close()
+            pool.join()
+        created = dict(zip(missing, new_nodes))
+
+    return [snapshot['nodes'].get(n) or created[n] for n in node_names]
+
+
+def _get_inventory_snapshot(conn, node_names, img_name):
+    # other users of the tenant may have nodes with the same names,
+    # only the requested names must be unique
+    nodes = {}
+    for n in conn.list_nodes():
+        if n.name in node_names:
+            assert n.name not in nodes
+            nodes[n.name] = n
+    return {
+        'nodes': nodes,
+        'image': _get_image(conn.list_images(), img_name),
+        'size': _get_flavor(conn.list_sizes(), node_flavor),
+        'primary_ssh_key': _get_primary_ssh_key(conn, cluster_primary_ssh_key)
+    }
+
+
+def _get_create_node_args(snapshot, sec_groups, metadata):
+    args = {'image': snapshot['image'], 'size': snapshot['size'],
+            'ex_keyname': snapshot['primary_ssh_key'].name,
+            'ex_security_groups': sec_groups,
+            'ex_metadata': metadata}
+    if cluster_additinal_ssh_keys:
+        sec_ssh_key_cloud_init = _get_cloud_init_with_sec_ssh_keys(cluster_additinal_ssh_keys)
+        args['ex_userdata'] = sec_ssh_key_cloud_init
+        args['ex_config_drive'] = True
+    return args
+
+
+def _create_instance(conn, node_name, create_args, retries):
+    """
+    create_node with retries and exponential backoff. Before a retry,
+    we check whether the failed call has not created the node anyway.
+    """
+    attempt = 0
+    while True:
+        try:
+            return conn.create_node(name=node_name, **create_args)
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(cluster_provisioning_backoff_sec * (2 ** attempt))
+            attempt = attempt + 1
+            existing_node = [n for n in conn.list_nodes() if n.name == node_name]
+            if existing_node:
+                return existing_node[0]
+
+
+def _get_image(all_images, img_name):
     img = [i for i in all_images if i.name == img_name]
     assert len(img) == 1
     return img[0]
 
 
-def _get_flavor(flavor_name):
-    all_sizes = os_conn.list_sizes()
+def _get_flavor(all_sizes, flavor_name):
     size = [s for s in all_sizes if s.name == flavor_name]
     assert len(size) == 1
     return size[0]
 
 
-def _get_primary_ssh_key(key_name):
-    return os_conn.get_key_pair(key_name)
+def _get_primary_ssh_key(conn, key_name):
+    return conn.get_key_pair(key_name)
 
 
 def _get_cloud_init_with_sec_ssh_keys(ssh_keys):
@@ -238,25 +1098,91 @@ ssh_authorized_keys:"""
 def _generate_ssh_config(nodes):
     """
     """
-    ssh_gateway = os_url.split(":")[1].replace("/", "").replace('identity', 'ssh').replace('-', '.')
+    names_and_ips = [(n[0].name, n[0].private_ips[0]) for n in nodes]
+    return _write_ssh_config("cluster_ssh_config", names_and_ips, ssh_multiplexing)
+
+
+def _write_ssh_config(file_name, names_and_ips, multiplexing):
+    ssh_gateway = _get_ssh_gateway()
 
     template = """
 Host {0}
     Hostname {1}
-    ProxyCommand ssh forward@{2} nc -q0 %h %p
+    ProxyCommand ssh {3}forward@{2} nc -q0 %h %p
     Port 22
     User ubuntu
     """
+    # the gateway path has no %h, ssh expands it to the node in ProxyCommand
+    gateway_options = ""
+    if multiplexing:
+        template = template + """ControlMaster auto
+    ControlPath ~/.ssh/leads-cluster-%r@%h:%p
+    ControlPersist {4}
+    """
+        gateway_options = "-o ControlMaster=auto -o ControlPath={0} -o ControlPersist={1} ".format(
+            _get_ssh_gateway_control_path(), ssh_control_persist)
 
     cluster_ssh_config = ""
-    for n in nodes:
-        entry = template.format(n[0].name, n[0].private_ips[0], ssh_gateway)
+    for name, ip in names_and_ips:
+        entry = template.format(name, ip, ssh_gateway, gateway_options, ssh_control_persist)
         cluster_ssh_config = cluster_ssh_config + entry + "\n"
 
-    with open("cluster_ssh_config", 'w') as f:
+    with open(file_name, 'w') as f:
         f.write(cluster_ssh_config)
         f.write("\n")
-    return "./cluster_ssh_config"
+    return "./" + file_name
+
+
+def _get_ssh_gateway():
+    return _get_os_url().split(":")[1].replace("/", "").replace('identity', 'ssh').replace('-', '.')
+
+
+def _get_ssh_gateway_control_path():
+    return "~/.ssh/leads-cluster-gateway-" + cluster_name
+
+
+def measure_ssh_connections(node=None, repeat=5):
+    """
+    Compares ssh connections and wall time of commands and uploads to a node,
+    with and without connection multiplexing
+    """
+    nodes = _get_inventory_nodes()
+    if node is not None:
+        nodes = [n for n in nodes if n['name'] == node]
+    name = nodes[0]['name']
+    names_and_ips = [(n['name'], n['private_ip']) for n in nodes]
+
+    x = PrettyTable(["Mode", "Commands", "New connections", "Time [s]"])
+    for mode, multiplexing in [("separate connections", False), ("multiplexed", True)]:
+        ssh_config = _write_ssh_config("tmp_ssh_config_measure", names_and_ips, multiplexing)
+        with open(os.devnull, 'w') as devnull:
+            commands = 0
+            new_connections = 0
+            start = time.time()
+            for i in range(0, int(repeat)):
+                for cmd in [["ssh", "-F", ssh_config, name, "true"],
+                            ["scp", "-F", ssh_config, ssh_config, name + ":" + ssh_config]]:
+                    # a command without a running master opens connections
+                    # to the node and to the gateway
+                    if not multiplexing:
+                        new_connections = new_connections + 2
+                    else:
+                        new_connections = new_connections + _count_missing_ssh_masters(ssh_config, name)
+                    subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+                    commands = commands + 1
+            x.add_row([mode, commands, new_connections, "{0:.2f}".format(time.time() - start)])
+    os.remove("tmp_ssh_config_measure")
+    print x
+
+
+def _count_missing_ssh_masters(ssh_config, name):
+    with open(os.devnull, 'w') as devnull:
+        node_master = subprocess.call(["ssh", "-F", ssh_config, "-O", "check", name],
+                                      stdout=devnull, stderr=devnull) == 0
+        gateway_master = subprocess.call(["ssh", "-o", "ControlPath=" + _get_ssh_gateway_control_path(),
+                                          "-O", "check", "forward@" + _get_ssh_gateway()],
+                                         stdout=devnull, stderr=devnull) == 0
+    return [node_master, gateway_master].count(False)
 
 
 def _generate_host_file(n_and_ips):
@@ -271,48 +1197,410 @@ def _generate_private_ips_file(n_and_ips):
         f.write(",".join(private_ips))
 
 
+def _generate_inventory_file(n_and_ips):
+    flavor = _get_node_flavor()
+    volumes = _get_os_conn().list_volumes() if use_data_volumes else []
+    inventory = {
+        'cluster_name': cluster_name,
+        'image': _get_node_image_name(),
+        'flavor': {'name': flavor.name, 'ram': flavor.ram,
+                   'vcpus': flavor.vcpus, 'disk': flavor.disk},
+        'metadata': node_metadata,
+        'nodes': [_get_inventory_node(n[0], volumes) for n in n_and_ips]
+    }
+    with open(cluster_inventory_file, 'w') as f:
+        json.dump(inventory, f, indent=2, sort_keys=True)
+    # the sizing follows the number of nodes
+    for func in [_get_inventory, _get_infinispan_sizing, _get_hadoop_sizing]:
+        func.cache.clear()
+
+
+@_memoized
+def _get_node_flavor():
+    return _get_flavor(_get_os_conn().list_sizes(), node_flavor)
+
+
+def _get_inventory_node(node, volumes=()):
+    return {'name': node.name,
+            'id': node.id,
+            'private_ip': node.private_ips[0],
+            'public_ips': node.public_ips,
+            'roles': _get_node_roles(node.name),
+            'site': _get_node_site(node.name),
+            'volumes': _get_node_volumes(node.name, volumes),
+            'metadata': node.extra.get('metadata', {})}
+
+
+def _get_node_roles(node_name):
+    return ['infinispan'] + sorted(r for r, r_hosts in env.roledefs.items() if node_name in r_hosts)
+
+
+@_memoized
+def _get_inventory():
+    """
+    Loads the inventory written by create_cluster and indexes the nodes
+    by name, by role and by site. The cloud is asked only if the file is missing.
+    """
+    if not os.path.exists(cluster_inventory_file):
+        _refresh_inventory()
+    with open(cluster_inventory_file, 'r') as f:
+        inventory = json.load(f)
+
+    inventory['by_name'] = dict((n['name'], n) for n in inventory['nodes'])
+    inventory['by_role'] = {}
+    inventory['by_site'] = {}
+    for n in inventory['nodes']:
+        # the inventories written before the sites
+        n.setdefault('site', _get_node_site(n['name']))
+        n.setdefault('volumes', [])
+        for role in n['roles']:
+            inventory['by_role'].setdefault(role, []).append(n)
+        inventory['by_site'].setdefault(n['site'], []).append(n)
+    return inventory
+
+
+def _get_inventory_nodes(role=None):
+    inventory = _get_inventory()
+    if role is None:
+        return inventory['nodes']
+    return inventory['by_role'].get(role, [])
+
+
+def refresh_inventory():
+    """
+    Rebuilds the cluster inventory and the host files from the cloud
+    """
+    _refresh_inventory()
+
+
+def _refresh_inventory(excluded=()):
+    nodes = [n for n in _get_os_conn().list_nodes()
+             if n.extra.get('metadata', {}).get('leads_cluster_name') == cluster_name and n.private_ips and
+             n.name not in excluded]
+    nodes.sort(key=lambda n: _get_node_id(n.name))
+    _generate_cluster_files([(n, n.private_ips) for n in nodes])
+
+
+def _get_node_id(node_name):
+    return int(node_name[len(node_name_prefix) + 1:])
+
+
+def _get_node_site(node_name):
+    node_id = str(_get_node_id(node_name))
+    for site, node_ids in cluster_sites:
+        if node_id in node_ids:
+            return site
+    return cluster_sites[0][0]
+
+
+def _get_site_members(nodes):
+    """
+    The first of the nodes in each site, by site
+    """
+    return dict((n['site'], n['name']) for n in reversed(nodes))
+
+
 @parallel
-def install_infinispan():
+def install_infinispan(force=False):
     """
+    Installs only the steps, whose inputs changed since the last run,
+    use install_infinispan:force=true to run all of them
     """
-    _install_jdk()
+    _apply_steps(_get_infinispan_package_steps() + _get_infinispan_config_steps(), force)
 
-    if not exists("infinispan.tgz"):
-        run("wget '" + infinispan_package_url+"' -O infinispan.tgz")
-        run("echo '" + infinispan_package_url+"' > infinispan.INFO")
-    if not exists("infinispan-server-7.0.1-SNAPSHOT"):
-        run("tar zxvf infinispan.tgz")
+
+def plan_deploy():
+    """
+    Shows which installation steps would run on the nodes
+    """
+    _apply_steps(_get_infinispan_package_steps() + _get_infinispan_config_steps() +
+                 _get_hadoop_package_steps() + _get_hadoop_config_steps(), dry_run=True)
+
+
+def _get_infinispan_package_steps():
+    return [
+        ('jdk', _fingerprint(jdk_package), _install_jdk),
+        ('infinispan_package', _get_infinispan_package_fingerprint(), _install_infinispan_package)
+    ]
+
+
+def _get_infinispan_config_steps():
+    # the package extraction overwrites the configuration and the init script
+    package_fingerprint = _get_infinispan_package_fingerprint()
     content = _get_infinispan_config()
+    jvm_options = _get_infinispan_jvm_config()
+    with open("templates/infinispan-server_template.sh", "r") as f:
+        initd_script = f.read()
+    return _get_data_volume_steps() + [
+        ('infinispan_config', _fingerprint(package_fingerprint, content),
+         lambda: _configure_infinispan(content)),
+        ('infinispan_jvm', _fingerprint(package_fingerprint, jvm_options),
+         lambda: _configure_infinispan_jvm(jvm_options)),
+        ('infinispan_initd', _fingerprint(package_fingerprint, initd_script), _install_initd_script),
+        _get_etc_hosts_step()
+    ]
+
+
+def _get_infinispan_package_fingerprint():
+    return _fingerprint(infinispan_package_url, _get_stored_artifact_digest(infinispan_package_url))
+
+
+def _install_infinispan_package():
+    if _install_artifact(infinispan_package_url, "infinispan.tgz", "infinispan-server-7.0.1-SNAPSHOT"):
+        run("echo '" + infinispan_package_url+"' > infinispan.INFO")
+
+
+def _configure_infinispan(content):
     tmp_file = _save_tmp_infinispan_config_file(content)
     _upload_with_scp(
         tmp_file,
         "infinispan-server-7.0.1-SNAPSHOT/standalone/configuration/infinispan-config.xml"
         )
-    _install_initd_script()
+
+
+def _configure_infinispan_jvm(content):
+    tmp_file = "tmp_" + env.host + "leads-standalone.conf"
+    with open(tmp_file, "w") as f:
+        f.write(content)
+    _upload_with_scp(tmp_file, "infinispan-server-7.0.1-SNAPSHOT/bin/leads-standalone.conf")
 
 
 def _install_jdk():
-    sudo("sudo apt-get update")
-    sudo("sudo apt-get install -yyf openjdk-7-jdk")
+    with resource_slots['downloads']:
+        sudo("sudo apt-get update")
+        sudo("sudo apt-get install -yyf " + jdk_package)
 
 
 def _get_infinispan_config():
     """
     """
-    with open("templates/infinispan-config_template.xml", "r") as f:
-        infinispan_config_template = f.read()
-
-    config = infinispan_config_template.replace("@NODE_IP@", env.host)
-    cluster_private_ips = _get_cluster_private_ips()
+    with open(infinispan_config_template, "r") as f:
+        config_template = f.read()
+
+    config = config_template.replace("@NODE_IP@", env.host)
+    node = _get_inventory()['by_name'][env.host]
+    site = node['site']
+    # the nodes discover only the members of their site
+    cluster_private_ips = _get_cluster_private_ips(site)
     config = config.replace("@TCPPING.initial_hosts@", cluster_private_ips)
+    for key, value in _get_xsite_config(site).items():
+        config = config.replace("@" + key + "@", value)
+    store_mounts = [v['mount'] for v in node['volumes'] if v['use'] == 'infinispan']
+    config = config.replace("@INFINISPAN_STORE_PATH@",
+                            store_mounts[0] + "/infinispan" if store_mounts else infinispan_store_path)
+    for key, value in _get_infinispan_sizing().items():
+        config = config.replace("@" + key.upper() + "@", str(value))
     return config
 
 
-def _get_cluster_private_ips():
-    with open("cluster_private_ips", 'r') as f:
-        private_ips = f.read().split(",")
+def _get_xsite_config(site):
+    """
+    The relay to the other sites and the backups of the distributed caches,
+    both are left out with a single site
+    """
+    remote_sites = sorted(s for s in _get_inventory()['by_site'] if s != site)
+    # any node becomes the site master, when it is the coordinator of its site
+    xsite_config = {'XSITE_TCPPING.initial_hosts': _get_cluster_private_ips(port=55300),
+                    'XSITE_RELAY': "", 'XSITE_BACKUPS': ""}
+    if not remote_sites:
+        return xsite_config
+    relay = ['<relay site="{0}">'.format(site)]
+    relay += ['  <remote-site name="{0}" stack="xsite" cluster="{1}-xsite"/>'.format(s, cluster_name)
+              for s in remote_sites]
+    relay += ['</relay>']
+    backups = ['<backups>']
+    backups += ['  <backup site="{0}" strategy="{1}" failure-policy="WARN" timeout="{2}"/>'.format(
+        s, xsite_backup_strategy, xsite_backup_timeout_ms) for s in remote_sites]
+    backups += ['</backups>']
+    xsite_config['XSITE_RELAY'] = "\n                ".join(relay)
+    xsite_config['XSITE_BACKUPS'] = "\n\t  ".join(backups)
+    return xsite_config
+
+
+def _get_infinispan_jvm_config():
+    with open(infinispan_jvm_template, "r") as f:
+        jvm_template = f.read()
+    return jvm_template.replace("@JAVA_OPTS@", _get_infinispan_sizing()['java_opts'])
+
+
+@_memoized
+def _get_infinispan_sizing():
+    flavor = _get_flavor_resources()
+    # each site is a cluster of its own, the smallest one decides
+    view_sizes = _get_infinispan_view_sizes(_get_inventory_nodes('infinispan'))
+    return _compute_infinispan_sizing(flavor['ram'], flavor['vcpus'],
+                                      min(view_sizes.values() or [0]),
+                                      _read_sizing_overrides(infinispan_sizing_file))
+
+
+def _get_infinispan_view_sizes(nodes):
+    """
+    The expected cluster view size by node name, the number of the nodes in its site
+    """
+    site_sizes = {}
+    for n in nodes:
+        site_sizes[n['site']] = site_sizes.get(n['site'], 0) + 1
+    return dict((n['name'], site_sizes[n['site']]) for n in nodes)
+
+
+def _get_flavor_resources():
+    flavor = _get_inventory().get('flavor') or {}
+    if not flavor.get('ram'):
+        size = _get_node_flavor()
+        flavor = {'ram': size.ram, 'vcpus': size.vcpus}
+    return {'ram': flavor['ram'], 'vcpus': flavor['vcpus'] or 1}
+
+
+def _read_sizing_overrides(file_name):
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, "r") as f:
+        return json.load(f)
+
+
+def _compute_infinispan_sizing(ram_mb, vcpus, num_of_nodes, overrides):
+    """
+    Derives the infinispan settings from the node flavor and the cluster size,
+    the values from overrides have the last word
+    """
+    # half of the memory for infinispan, the rest for hadoop and the system
+    heap_mb = max(512, int(ram_mb * 0.5) // 64 * 64)
+    sizing = {
+        'heap_mb': heap_mb,
+        'owners': 2 if num_of_nodes > 1 else 1,
+        # ~20 segments per node keep the data spread evenly
+        'segments': max(20, 20 * num_of_nodes),
+        'concurrency_level': max(1000, 500 * vcpus),
+        'transport_max_threads': max(25, 10 * vcpus),
+        'jca_threads': max(50, 25 * vcpus),
+        # 1000 entries per 512 MB of heap
+        'eviction_max_entries': max(1000, heap_mb // 512 * 1000)
+    }
+    sizing.update(overrides)
+    if 'java_opts' not in overrides:
+        sizing['java_opts'] = "-Xms{0}m -Xmx{0}m -XX:MaxPermSize=256m -Djava.net.preferIPv4Stack=true " \
+                              "-Djboss.modules.system.pkgs=org.jboss.byteman " \
+                              "-Djava.awt.headless=true".format(sizing['heap_mb'])
+    return sizing
+
+
+def show_infinispan_sizing():
+    """
+    Shows the infinispan sizing profile for the cluster
+    """
+    x = PrettyTable(["Setting", "Value"])
+    x.align = "l"
+    for key, value in sorted(_get_infinispan_sizing().items()):
+        x.add_row([key, value])
+    print x
+
+
+@_memoized
+def _get_hadoop_sizing():
+    flavor = _get_flavor_resources()
+    infinispan_heap_mb = 0
+    if _get_inventory_nodes('infinispan'):
+        infinispan_heap_mb = _get_infinispan_sizing()['heap_mb']
+    return _compute_hadoop_sizing(flavor['ram'], flavor['vcpus'], infinispan_heap_mb,
+                                  len(set(env.roledefs['masters'] + env.roledefs['slaves'])),
+                                  _read_sizing_overrides(hadoop_sizing_file))
+
+
+def _compute_hadoop_sizing(ram_mb, vcpus, infinispan_heap_mb, num_of_nodemanagers, overrides):
+    """
+    Derives the yarn and mapreduce settings from the node flavor, the memory
+    left after the system, the infinispan JVM and the hadoop daemons goes to
+    the containers, the values from overrides have the last word
+    """
+    if ram_mb <= 8192:
+        hadoop_heapsize = 512
+    elif ram_mb < 32768:
+        hadoop_heapsize = 1000
+    else:
+        hadoop_heapsize = 2000
+    if ram_mb <= 4096:
+        system_mb = 512
+    elif ram_mb < 16384:
+        system_mb = 1024
+    else:
+        system_mb = 2048
+    # the infinispan JVM takes more than its heap: perm gen, thread stacks, buffers
+    infinispan_mb = infinispan_heap_mb + 256 + infinispan_heap_mb // 16 if infinispan_heap_mb else 0
+    # the master runs namenode and datanode (HADOOP_HEAPSIZE), resourcemanager and nodemanager
+    # (YARN_HEAPSIZE), the containers are the same on all the nodes, so they are sized for the master
+    available_mb = ram_mb - system_mb - infinispan_mb - 4 * hadoop_heapsize
+    if available_mb < 256 and hadoop_heapsize > 256:
+        # on small flavors, the daemons give way to the containers
+        available_mb += 4 * (hadoop_heapsize - 256)
+        hadoop_heapsize = 256
+    # without room for a container, the sizing is reported as short of memory
+    available_mb = max(256, available_mb)
+
+    if available_mb <= 4096:
+        min_container_mb = 256
+    elif available_mb <= 8192:
+        min_container_mb = 512
+    elif available_mb <= 24576:
+        min_container_mb = 1024
+    else:
+        min_container_mb = 2048
+    containers = max(1, min(2 * vcpus, available_mb // min_container_mb))
+    container_mb = max(min_container_mb, available_mb // containers // 128 * 128)
+    nodemanager_mb = containers * container_mb
+
+    map_mb = container_mb
+    reduce_mb = min(2 * container_mb, nodemanager_mb)
+    sizing = {
+        'hadoop_heapsize': hadoop_heapsize,
+        'yarn_heapsize': hadoop_heapsize,
+        'nodemanager_memory_mb': nodemanager_mb,
+        'nodemanager_vcores': vcpus,
+        'scheduler_min_allocation_mb': container_mb,
+        'scheduler_max_allocation_mb': nodemanager_mb,
+        'scheduler_max_allocation_vcores': vcpus,
+        'am_memory_mb': reduce_mb,
+        'map_memory_mb': map_mb,
+        'reduce_memory_mb': reduce_mb,
+        'map_tasks': containers * num_of_nodemanagers,
+        'reduce_tasks': max(1, containers * num_of_nodemanagers * 3 // 4),
+        # the sort buffer lives in the map task heap
+        'io_sort_mb': min(1024, int(map_mb * 0.8 * 0.4)),
+    }
+    sizing.update(overrides)
+    # heaps at 80% of the containers, the rest is for the non-heap JVM memory
+    for name in ['am', 'map', 'reduce']:
+        if name + '_java_opts' not in overrides:
+            sizing[name + '_java_opts'] = "-Xmx{0}m".format(int(sizing[name + '_memory_mb'] * 0.8))
+    if 'io_sort_factor' not in overrides:
+        sizing['io_sort_factor'] = min(100, max(10, sizing['io_sort_mb'] // 10))
+    sizing['memory_shortfall_mb'] = max(0, system_mb + infinispan_mb + 2 * sizing['hadoop_heapsize'] +
+                                        2 * sizing['yarn_heapsize'] + sizing['nodemanager_memory_mb'] - ram_mb)
+    return sizing
+
+
+def _check_hadoop_memory(sizing):
+    if sizing['memory_shortfall_mb']:
+        error("The yarn containers, the hadoop daemons and the infinispan JVM need {0} MB more than the node has, "
+              "lower heap_mb in {1}, the values in {2} or use a bigger flavor!".format(
+                  sizing['memory_shortfall_mb'], infinispan_sizing_file, hadoop_sizing_file))
+
+
+def show_hadoop_sizing():
+    """
+    Shows the yarn and mapreduce sizing profile for the cluster
+    """
+    x = PrettyTable(["Setting", "Value"])
+    x.align = "l"
+    for key, value in sorted(_get_hadoop_sizing().items()):
+        x.add_row([key, value])
+    print x
+    _check_hadoop_memory(_get_hadoop_sizing())
+
+
+def _get_cluster_private_ips(site=None, port=55200):
+    private_ips = [n['private_ip'] for n in _get_inventory_nodes() if site in (None, n['site'])]
 
-    result = [p_i + "[55200]" for p_i in private_ips]
+    result = [p_i + "[{0}]".format(port) for p_i in private_ips]
     result = ",".join(result)
     return result
 
@@ -341,6 +1629,278 @@ def _upload_with_scp(what, where):
         local("scp -F {0} {1} {2}:{3}".format(env.ssh_config_path, what, env.host_string, where))
 
 
+def _apply_steps(steps, force=False, dry_run=False):
+    """
+    Runs the steps (name, fingerprint, function), whose fingerprint differs
+    from the one recorded in the manifest on the node
+    """
+    manifest = _read_manifest()
+    # the infinispan and the hadoop steps share some (etc_hosts, data_volumes), each runs once
+    unique_steps = []
+    for step in steps:
+        if step[0] not in [s[0] for s in unique_steps]:
+            unique_steps.append(step)
+    plan = [(name, fingerprint, func, _to_bool(force) or manifest.get(name) != fingerprint)
+            for name, fingerprint, func in unique_steps]
+
+    x = PrettyTable(["Host", "Step", "Action"])
+    for name, fingerprint, func, changed in plan:
+        if name not in manifest:
+            action = "install"
+        else:
+            action = "update" if changed else "skip"
+        x.add_row([env.host_string, name, action])
+    print x
+
+    if dry_run:
+        return
+    for name, fingerprint, func, changed in plan:
+        if changed:
+            func()
+            manifest[name] = fingerprint
+            _write_manifest(manifest)
+
+
+def _fingerprint(*inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _read_manifest():
+    with settings(hide('running', 'stdout'), warn_only=True):
+        content = run("cat {0} 2>/dev/null || echo '{{}}'".format(node_manifest_file))
+    return json.loads(content)
+
+
+def _write_manifest(manifest):
+    with hide('running', 'stdout'):
+        run("mkdir -p $(dirname {0}) && echo '{1}' > {0}".format(
+            node_manifest_file, json.dumps(manifest, sort_keys=True)))
+
+
+def _install_artifact(url, file_name, dir_name):
+    """
+    Extracts the artifact to dir_name, unless dir_name already holds
+    the artifact with the same sha256. Returns True, if it was extracted.
+    """
+    url_key = hashlib.sha256(url).hexdigest()
+    with settings(hide('running', 'stdout'), warn_only=True):
+        installed, node_url_digest = run(
+            "printf '%s %s' \"$(cat {0}/.leads_artifact 2>/dev/null || echo none)\" "
+            "\"$(cat {1}/urls/{2} 2>/dev/null || echo none)\"".format(
+                dir_name, node_artifact_store_dir, url_key)).split()
+
+    expected = _get_stored_artifact_digest(url) or node_url_digest
+    if installed != "none" and installed == expected:
+        return False
+
+    with settings(hide('stdout'), warn_only=True):
+        digest = run("test -f {0} && sha256sum {0} | cut -d' ' -f1".format(file_name)).strip()
+    if expected != "none":
+        outdated = digest != expected
+    else:
+        # nothing is recorded for a new url, the file may hold the artifact of the previous one,
+        # distribute_artifacts has just put the file of this url there
+        outdated = artifact_distribution == "direct"
+    if not digest or outdated:
+        if artifact_distribution != "direct":
+            error("{0} is missing or outdated on {1}, run distribute_artifacts first!".format(
+                file_name, env.host_string))
+        with resource_slots['downloads']:
+            run("rm -f {0}; wget -c '{1}' -O {0}".format(file_name, url))
+        digest = run("sha256sum {0} | cut -d' ' -f1".format(file_name)).strip()
+
+    store = node_artifact_store_dir
+    run("mkdir -p {0}/urls && if [ ! -L {1} ]; then mv -f {1} {0}/{2}; fi && "
+        "ln -sfn {0}/{2} {1} && touch {0}/{2} && echo {2} > {0}/urls/{3}".format(
+            store, file_name, digest, url_key))
+    _evict_node_artifacts()
+
+    run("rm -rf {0} && tar zxf {1} && echo {2} > {0}/.leads_artifact".format(dir_name, file_name, digest))
+    return True
+
+
+def _evict_node_artifacts():
+    # the most recently used artifact is always kept
+    run("cd {0} && ls -1t | grep -v '^urls$' | "
+        "(n=0; t=0; while read f; do n=$((n+1)); t=$((t+$(stat -c %s $f))); "
+        "if [ $n -gt 1 ] && [ $t -gt {1} ]; then rm -f $f; fi; done)".format(
+            node_artifact_store_dir, artifact_store_max_mb * 1024 * 1024))
+
+
+def distribute_artifacts():
+    """
+    Downloads each artifact once and copies it to the nodes through a tree
+    over the private network, usage:
+    fab distribute_artifacts --ssh-config-path=cluster_ssh_config
+    """
+    if artifact_distribution == "direct":
+        error("Set LEADS_CLUSTER_ARTIFACT_DISTRIBUTION to workstation or master")
+
+    all_nodes = [n['name'] for n in _get_inventory_nodes()]
+    hadoop_nodes = [n for n in all_nodes if n in env.roledefs['masters'] + env.roledefs['slaves']]
+    _distribute_artifact(infinispan_package_url, "infinispan.tgz", all_nodes)
+    _distribute_artifact(hadoop_package_url, _get_hadoop_pkg_name(hadoop_package_url), hadoop_nodes)
+
+
+def _distribute_artifact(url, file_name, node_names):
+    if not node_names:
+        return
+    seed = hadoop_master_node if hadoop_master_node in node_names else node_names[0]
+
+    if artifact_distribution == "workstation":
+        local_path, digest = _get_stored_artifact(url)
+        digests = execute(_get_artifact_digest, file_name, hosts=node_names)
+        if digests[seed] != digest:
+            local("rsync --partial -e 'ssh -F {0}' {1} {2}:{3}".format(
+                env.ssh_config_path, local_path, seed, file_name))
+            digests.update(execute(_get_artifact_digest, file_name, hosts=[seed]))
+            if digests[seed] != digest:
+                error("Checksum of {0} does not match on {1}!".format(file_name, seed))
+    else:
+        execute(_download_artifact_on_node, url, file_name, hosts=[seed])
+        digests = execute(_get_artifact_digest, file_name, hosts=node_names)
+        digest = digests[seed]
+
+    # every round, each node with the artifact copies it to one node without it,
+    # so the number of copies doubles
+    holders = [n for n in node_names if digests[n] == digest]
+    pending = [n for n in node_names if n not in holders]
+    while pending:
+        pushes = {}
+        for holder, target in zip(holders, pending):
+            pushes[holder] = get_node_private_ip(target)
+        targets = pending[:len(pushes)]
+        execute(_push_artifact, file_name, pushes, hosts=pushes.keys())
+
+        digests = execute(_get_artifact_digest, file_name, hosts=targets)
+        corrupted = [t for t in targets if digests[t] != digest]
+        if corrupted:
+            error("Checksum of {0} does not match on {1}!".format(file_name, ", ".join(corrupted)))
+        holders = holders + targets
+        pending = pending[len(targets):]
+
+
+def _get_stored_artifact(url):
+    """
+    Returns path and sha256 of the artifact in the workstation store,
+    downloads it only if the url is not in the store yet
+    """
+    index = _load_artifact_index()
+    entry = index.get(url)
+    if entry:
+        path = os.path.join(artifact_store_dir, entry['digest'])
+        if os.path.exists(path):
+            os.utime(path, None)
+            return path, entry['digest']
+
+    tmp_path = _download_artifact(url, os.path.join(artifact_store_dir, "tmp"),
+                                  hashlib.sha256(url).hexdigest())
+    digest = _sha256_file(tmp_path)
+    path = os.path.join(artifact_store_dir, digest)
+    os.rename(tmp_path, path)
+
+    index[url] = {'digest': digest, 'size': os.path.getsize(path)}
+    _evict_stored_artifacts(index, keep=digest)
+    with open(os.path.join(artifact_store_dir, "index.json"), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    return path, digest
+
+
+def _get_stored_artifact_digest(url):
+    entry = _load_artifact_index().get(url)
+    return entry['digest'] if entry else None
+
+
+def _load_artifact_index():
+    index_file = os.path.join(artifact_store_dir, "index.json")
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+
+def _evict_stored_artifacts(index, keep):
+    blobs = [(os.path.getmtime(os.path.join(artifact_store_dir, e['digest'])), u, e['digest'])
+             for u, e in index.items()
+             if os.path.exists(os.path.join(artifact_store_dir, e['digest']))]
+    total = sum(os.path.getsize(os.path.join(artifact_store_dir, d)) for m, u, d in blobs)
+    for mtime, url, digest in sorted(blobs):
+        if total <= artifact_store_max_mb * 1024 * 1024:
+            break
+        if digest == keep:
+            continue
+        path = os.path.join(artifact_store_dir, digest)
+        if os.path.exists(path):
+            total = total - os.path.getsize(path)
+            os.remove(path)
+        del index[url]
+
+
+def _download_artifact(url, local_dir, file_name):
+    """
+    Downloads the artifact to the workstation, continues a partial download
+    """
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    path = os.path.join(local_dir, file_name)
+
+    request = urllib2.Request(url)
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset:
+        request.add_header('Range', 'bytes={0}-'.format(offset))
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        # the range starts at the end of the file, it is complete
+        if e.code == 416:
+            return path
+        raise
+
+    mode = 'ab' if response.getcode() == 206 else 'wb'
+    with open(path, mode) as f:
+        for chunk in iter(lambda: response.read(1024 * 1024), ''):
+            f.write(chunk)
+    return path
+
+
+def _sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _download_artifact_on_node(url, file_name):
+    """
+    Keeps the file only if it holds the artifact recorded for the url,
+    a partial download is continued from a file of its own url
+    """
+    url_key = hashlib.sha256(url).hexdigest()
+    with settings(hide('running', 'stdout'), warn_only=True):
+        matches = run("test -f {0} && [ \"$(sha256sum {0} | cut -d' ' -f1)\" = "
+                      "\"$(cat {1}/urls/{2} 2>/dev/null)\" ]".format(
+                          file_name, node_artifact_store_dir, url_key)).succeeded
+    if matches:
+        return
+    partial = "{0}.{1}.part".format(file_name, url_key[:12])
+    with resource_slots['downloads']:
+        run("wget -c '{0}' -O {1} && rm -f {2} && mv {1} {2}".format(url, partial, file_name))
+
+
+@parallel
+def _get_artifact_digest(file_name):
+    with settings(hide('running', 'stdout'), warn_only=True):
+        return run("test -f {0} && sha256sum {0} | cut -d' ' -f1".format(file_name)).strip()
+
+
+@parallel
+def _push_artifact(file_name, pushes):
+    # the file is a link to the artifact store after the installation
+    run("rsync -L --partial -e 'ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null' "
+        "{0} ubuntu@{1}:{0}".format(file_name, pushes[env.host_string]))
+
+
 @parallel
 def start_infinispan_service():
     sudo("sudo service infinispan-server start", pty=True)
@@ -351,6 +1911,654 @@ def stop_infinispan_service():
     sudo("sudo service infinispan-server stop", pty=True)
 
 
+def wait_for_infinispan_cluster(timeout=300):
+    """
+    Waits until every node answers on hotrod and jgroups ports and sees
+    all the nodes of its site in its cluster view, usage:
+    fab wait_for_infinispan_cluster[:timeout=300]
+    """
+    nodes = _get_inventory_nodes('infinispan')
+    endpoints, tunnels = _open_infinispan_endpoints(nodes)
+    try:
+        timings = _wait_for_infinispan_view(endpoints, _get_infinispan_view_sizes(nodes), float(timeout))
+    finally:
+        _close_ssh_tunnels(tunnels)
+
+    x = PrettyTable(["Node name", "Site", "HotRod [s]", "JGroups [s]", "View size", "Formation [s]"])
+    for n in nodes:
+        t = timings[n['name']]
+        x.add_row([n['name'], n['site']] + ["-" if t.get(k) is None else "{0:.1f}".format(t[k])
+                                 for k in ('hotrod', 'jgroups')] +
+                  [t['view_size'], "-" if t.get('formed') is None else "{0:.1f}".format(t['formed'])])
+    print x
+    not_formed = [name for name, t in timings.items() if t.get('formed') is None]
+    if not_formed:
+        error("Cluster view not formed on {0}!".format(", ".join(sorted(not_formed))))
+
+
+def rolling_restart_infinispan(upgrade=False, timeout=600):
+    """
+    Restarts infinispan at most owners-1 nodes at a time, waits until the
+    nodes rejoin and the state transfer is over before the next ones.
+    With upgrade=true, changed packages and configuration are installed
+    on the stopped nodes, usage:
+    fab rolling_restart_infinispan[:upgrade=true] --ssh-config-path=cluster_ssh_config
+    """
+    caches = _get_infinispan_distributed_caches()
+    batch_size = max(1, _get_infinispan_sizing()['owners'] - 1)
+    nodes = _get_inventory_nodes('infinispan')
+    names = [n['name'] for n in nodes]
+
+    endpoints, tunnels = _open_infinispan_endpoints(nodes)
+    try:
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i + batch_size]
+            start = time.time()
+            _execute_bounded(_restart_infinispan_node, batch, upgrade)
+
+            timings = _wait_for_infinispan_view(endpoints, _get_infinispan_view_sizes(nodes), float(timeout))
+            not_formed = [name for name, t in timings.items() if t.get('formed') is None]
+            if not_formed:
+                error("Cluster view not formed on {0}, stopping the rolling restart!".format(
+                    ", ".join(sorted(not_formed))))
+            for name in _get_site_members([n for n in nodes if n['name'] in batch]).values():
+                _wait_for_infinispan_rebalance(endpoints[name]['management'], caches,
+                                               float(timeout) - (time.time() - start))
+            print "Restarted {0} in {1:.1f}s".format(", ".join(batch), time.time() - start)
+    finally:
+        _close_ssh_tunnels(tunnels)
+
+
+def _get_infinispan_distributed_caches():
+    with open(infinispan_config_template, "r") as f:
+        config_template = f.read()
+    return re.findall(r'<distributed-cache name="([^"]+)"', config_template)
+
+
+@parallel
+def _restart_infinispan_node(upgrade):
+    stop_infinispan_service()
+    if _to_bool(upgrade):
+        _apply_steps(_get_infinispan_package_steps() + _get_infinispan_config_steps())
+    start_infinispan_service()
+
+
+def _wait_for_infinispan_rebalance(management_address, caches, timeout):
+    deadline = time.time() + timeout
+    for cache in sorted(caches):
+        address = [{"subsystem": "infinispan"},
+                   {"cache-container": infinispan_cache_container},
+                   {"distributed-cache": cache}]
+        while True:
+            # the next nodes go down only after a confirmed state transfer
+            try:
+                status = _read_infinispan_attribute(management_address, address, "cache-rebalancing-status")
+                if status not in ("PENDING", "IN_PROGRESS"):
+                    break
+            except Exception as e:
+                status = "unknown ({0})".format(e)
+            if time.time() > deadline:
+                error("State transfer of {0} did not finish in time, rebalancing status: {1}!".format(
+                    cache, status))
+            time.sleep(2)
+
+
+def monitor_infinispan(interval=10, duration=0):
+    """
+    Polls the cache and JVM statistics of all the nodes every interval
+    seconds (for duration seconds, 0 - until interrupted) and appends them
+    to the statistics file, see show_infinispan_stats
+    """
+    interval = float(interval)
+    duration = float(duration)
+    caches = _get_infinispan_distributed_caches()
+    nodes = _get_inventory_nodes('infinispan')
+    names = [n['name'] for n in nodes]
+    endpoints, tunnels = _open_infinispan_endpoints(nodes)
+    pool = multiprocessing.pool.ThreadPool(max(1, min(infinispan_probe_workers, len(names))))
+    if not os.path.exists(infinispan_stats_file):
+        with open(infinispan_stats_file, "w") as f:
+            f.write(json.dumps({'cache_fields': infinispan_cache_stats,
+                                'jvm_fields': infinispan_jvm_stats}) + "\n")
+    try:
+        _wait_for_ssh_tunnels(endpoints, tunnels)
+        start = time.time()
+        while not duration or time.time() - start < duration:
+            sample_start = time.time()
+            samples = pool.map(lambda name: _get_infinispan_stats(endpoints[name]['management'], caches),
+                               names)
+            with open(infinispan_stats_file, "a") as f:
+                for name, sample in zip(names, samples):
+                    for series, values in sorted((sample or {}).items()):
+                        f.write(json.dumps([int(sample_start), name, series] + values) + "\n")
+            failed = [name for name, sample in zip(names, samples) if sample is None]
+            print "{0}: {1} nodes sampled{2}".format(
+                time.strftime("%H:%M:%S"), len(names) - len(failed),
+                ", failed: " + ", ".join(failed) if failed else "")
+            time.sleep(max(0, interval - (time.time() - sample_start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+        pool.join()
+        _close_ssh_tunnels(tunnels)
+
+
+def _get_infinispan_stats(management_address, caches):
+    """
+    Reads the statistics of the caches and of the JVM in one management
+    request, returns series (cache name or jvm) -> values, None if the
+    node does not answer
+    """
+    container = [{"subsystem": "infinispan"}, {"cache-container": infinispan_cache_container}]
+    platform = [{"core-service": "platform-mbean"}]
+    steps = [{"operation": "read-resource", "include-runtime": True,
+              "address": container + [{"distributed-cache": cache}]} for cache in caches]
+    steps.append({"operation": "read-attribute", "name": "heap-memory-usage",
+                  "address": platform + [{"type": "memory"}]})
+    steps.append({"operation": "read-resource", "include-runtime": True, "recursive": True,
+                  "address": platform + [{"type": "garbage-collector"}]})
+    try:
+        response = _infinispan_management_request(
+            management_address, {"operation": "composite", "address": [], "steps": steps})
+    except Exception:
+        return None
+    if response.get("outcome") != "success":
+        return None
+    results = [response["result"]["step-{0}".format(i + 1)].get("result") or {}
+               for i in range(0, len(steps))]
+
+    sample = {}
+    for cache, stats in zip(caches, results):
+        sample[cache] = [_to_number(stats.get(name)) for name in infinispan_cache_stats]
+    heap, collectors = results[-2], results[-1].get("name") or {}
+    sample['jvm'] = [_to_number(heap.get("used")) // 2 ** 20, _to_number(heap.get("max")) // 2 ** 20,
+                     sum(_to_number(c.get("collection-count")) for c in collectors.values()),
+                     sum(_to_number(c.get("collection-time")) for c in collectors.values())]
+    return sample
+
+
+def _to_number(value):
+    try:
+        return float(value) if "." in str(value) else int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def show_infinispan_stats(file_name=None, minutes=60):
+    """
+    Summarizes the statistics of the last minutes: per cache the cluster-wide
+    hit ratio, the evictions and the store reads, per node the share of the
+    operations and the JVM heap and GC
+    """
+    file_name = file_name or infinispan_stats_file
+    with open(file_name, "r") as f:
+        header = json.loads(f.readline())
+        rows = [json.loads(line) for line in f if line.strip()]
+    if not rows:
+        error("No samples in " + file_name)
+    since = max(r[0] for r in rows) - float(minutes) * 60
+    # series -> the first and the last sample of each node
+    first = {}
+    last = {}
+    for r in rows:
+        if r[0] < since:
+            continue
+        first.setdefault((r[1], r[2]), r)
+        last[(r[1], r[2])] = r
+
+    def delta(key, field, fields):
+        i = 3 + fields.index(field)
+        # the counters start from zero again after a restart
+        return last[key][i] - first[key][i] if last[key][i] >= first[key][i] else last[key][i]
+
+    cache_fields = header['cache_fields']
+    x = PrettyTable(["Cache", "Hits", "Misses", "Hit ratio", "Evictions", "Store reads",
+                     "Store writes", "Store reads/eviction", "Avg read [ms]", "Avg write [ms]"])
+    x.align = "l"
+    node_ops = {}
+    seconds = {}
+    for cache in sorted(set(k[1] for k in last if k[1] != 'jvm')):
+        keys = [k for k in last if k[1] == cache]
+        totals = dict((field, sum(delta(k, field, cache_fields) for k in keys))
+                      for field in ('hits', 'misses', 'evictions', 'cache-loader-loads', 'cache-loader-stores'))
+        for k in keys:
+            node_ops[k[0]] = node_ops.get(k[0], 0) + sum(delta(k, field, cache_fields)
+                                                         for field in ('hits', 'misses', 'stores'))
+            seconds[k[0]] = max(1, last[k][0] - first[k][0])
+        reads = totals['hits'] + totals['misses']
+        x.add_row([cache, totals['hits'], totals['misses'],
+                   "{0:.2f}".format(totals['hits'] / float(reads)) if reads else "-",
+                   totals['evictions'], totals['cache-loader-loads'], totals['cache-loader-stores'],
+                   # close to 1: the evicted entries are read back from the store right away
+                   "{0:.2f}".format(totals['cache-loader-loads'] / float(totals['evictions']))
+                   if totals['evictions'] else "-"] +
+                  ["{0:.1f}".format(sum(last[k][3 + cache_fields.index(field)] for k in keys) /
+                                    float(len(keys))) for field in ('average-read-time', 'average-write-time')])
+    print x
+
+    jvm_fields = header['jvm_fields']
+    average_ops = sum(node_ops.values()) / float(len(node_ops)) if node_ops else 0
+    x = PrettyTable(["Node", "Ops/s", "Share", "Heap used [MB]", "Heap max [MB]", "GC time [ms/s]", ""])
+    x.align = "l"
+    for node in sorted(node_ops, key=node_ops.get, reverse=True):
+        jvm = last.get((node, 'jvm'))
+        row = [node, "{0:.1f}".format(node_ops[node] / float(seconds[node])),
+               "{0:.0f}%".format(100.0 * node_ops[node] / sum(node_ops.values())) if average_ops else "-"]
+        if jvm:
+            row += [jvm[3 + jvm_fields.index('heap_used_mb')], jvm[3 + jvm_fields.index('heap_max_mb')],
+                    "{0:.1f}".format(delta((node, 'jvm'), 'gc_time_ms', jvm_fields) /
+                                     float(max(1, jvm[0] - first[(node, 'jvm')][0])))]
+        else:
+            row += ["-", "-", "-"]
+        row.append("HOT" if average_ops and node_ops[node] > 1.5 * average_ops else "")
+        x.add_row(row)
+    print x
+
+
+def _open_infinispan_endpoints(nodes):
+    """
+    Returns node name -> port name -> (host, port) and the tunnel processes
+    """
+    _use_cluster_ssh_config()
+    endpoints = {}
+    tunnels = []
+    for n in nodes:
+        if infinispan_probe_via_ssh:
+            endpoints[n['name']], tunnel = _open_ssh_tunnel(n, infinispan_ports)
+            tunnels.append(tunnel)
+        else:
+            endpoints[n['name']] = dict((name, (n['private_ip'], port))
+                                        for name, port in infinispan_ports.items())
+    return endpoints, tunnels
+
+
+def _use_cluster_ssh_config():
+    # without --ssh-config-path, fabric points to ~/.ssh/config, which does not know the nodes
+    if env.ssh_config_path == default_ssh_config_path:
+        env.ssh_config_path = "./cluster_ssh_config"
+        # fabric caches the parsed ssh config
+        env.pop('_ssh_config', None)
+
+
+def _open_ssh_tunnel(node, ports):
+    forwards = []
+    local_endpoints = {}
+    for name, port in sorted(ports.items()):
+        local_port = _get_free_local_port()
+        forwards.extend(["-L", "127.0.0.1:{0}:{1}:{2}".format(local_port, node['private_ip'], port)])
+        local_endpoints[name] = ("127.0.0.1", local_port)
+    with open(os.devnull, 'w') as devnull:
+        tunnel = subprocess.Popen(["ssh", "-F", env.ssh_config_path, "-N",
+                                   "-o", "ExitOnForwardFailure=yes"] + forwards + [node['name']],
+                                  stdout=devnull, stderr=devnull)
+    return local_endpoints, tunnel
+
+
+def _wait_for_ssh_tunnels(endpoints, tunnels, timeout=ssh_tunnel_timeout_sec):
+    """
+    Waits until the forwarded ports of all the tunnels listen
+    """
+    if not tunnels:
+        return
+    pending = [address for ports in endpoints.values() for address in ports.values()]
+    deadline = time.time() + timeout
+    while pending:
+        if any(tunnel.poll() is not None for tunnel in tunnels):
+            error("An ssh tunnel exited before its ports were forwarded")
+        pending = [address for address in pending if not _is_port_open(address)]
+        if pending and time.time() > deadline:
+            error("The ssh tunnels did not forward {0} in {1} seconds".format(
+                ", ".join("{0}:{1}".format(*address) for address in sorted(pending)), timeout))
+        if pending:
+            time.sleep(0.5)
+
+
+def _get_free_local_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _close_ssh_tunnels(tunnels):
+    for tunnel in tunnels:
+        if tunnel.poll() is None:
+            tunnel.terminate()
+            tunnel.wait()
+
+
+def _wait_for_infinispan_view(endpoints, expected_sizes, timeout):
+    """
+    Probes all the nodes concurrently until their views reach expected_sizes
+    (by node name), returns per node the time when hotrod and jgroups ports
+    answered, the view size and the time of the cluster formation (None, if
+    it did not happen before timeout)
+    """
+    start = time.time()
+
+    def probe_node(name):
+        node_endpoints = endpoints[name]
+        t = {'hotrod': None, 'jgroups': None, 'view_size': 0, 'formed': None}
+        while time.time() - start < timeout:
+            for port_name in ('hotrod', 'jgroups'):
+                if t[port_name] is None and _is_port_open(node_endpoints[port_name]):
+                    t[port_name] = time.time() - start
+            if t['hotrod'] is not None and t['jgroups'] is not None:
+                t['view_size'] = _get_infinispan_view_size(node_endpoints['management'])
+                if t['view_size'] >= expected_sizes[name]:
+                    t['formed'] = time.time() - start
+                    break
+            time.sleep(1)
+        return t
+
+    names = sorted(endpoints)
+    pool = multiprocessing.pool.ThreadPool(max(1, min(infinispan_probe_workers, len(names))))
+    try:
+        return dict(zip(names, pool.map(probe_node, names)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _is_port_open(address, timeout=2):
+    try:
+        socket.create_connection(address, timeout).close()
+        return True
+    except socket.error:
+        return False
+
+
+def _get_infinispan_view_size(management_address):
+    """
+    Number of members in the cluster view of the cache container, 0 if unknown
+    """
+    try:
+        members = _read_infinispan_attribute(
+            management_address, [{"subsystem": "infinispan"},
+                                 {"cache-container": infinispan_cache_container}], "members")
+    except Exception:
+        return 0
+    if isinstance(members, list):
+        return len(members)
+    return len([m for m in str(members).strip("[]").split(",") if m.strip()])
+
+
+def _read_infinispan_attribute(management_address, address, name):
+    result = _infinispan_management_request(
+        management_address, {"operation": "read-attribute", "address": address,
+                             "name": name, "include-runtime": True})
+    if result.get("outcome") != "success":
+        raise Exception(result.get("failure-description"))
+    return result["result"]
+
+
+def _infinispan_management_request(management_address, operation):
+    url = "http://{0}:{1}/management".format(*management_address)
+    handlers = []
+    if infinispan_mgmt_user:
+        auth_handler = urllib2.HTTPDigestAuthHandler()
+        auth_handler.add_password("ManagementRealm", url, infinispan_mgmt_user, infinispan_mgmt_password)
+        handlers.append(auth_handler)
+    request = urllib2.Request(url, json.dumps(operation), {"Content-Type": "application/json"})
+    try:
+        response = urllib2.build_opener(*handlers).open(request, timeout=5)
+    except urllib2.HTTPError as e:
+        # failed operations come with 500 and the outcome in the body
+        response = e
+    return json.load(response)
+
+
+def benchmark_infinispan(workload="mixed", duration=30, workers=4, caches=None, keys=10000,
+                         value_size=1024, get_ratio=0.9, targets=None, compare=None):
+    """
+    Drives get, put or mixed load against the caches from worker processes,
+    prints ops/s and the latency percentiles per node and cache, and saves
+    them as JSON; targets (host[:hotrod port[:memcached port]];...) skips
+    the inventory, e.g. targets=127.0.0.1 for a local server
+    """
+    if workload not in ('get', 'put', 'mixed'):
+        error("Unknown workload: {0}, use get, put or mixed".format(workload))
+    get_ratio = {'get': 1.0, 'put': 0.0}.get(workload, float(get_ratio))
+    caches = caches.split(";") if caches else sorted(benchmark_caches)
+
+    tunnels = []
+    if targets:
+        endpoints = {}
+        for target in targets.split(";"):
+            parts = target.split(":")
+            host, ports = parts[0], [int(p) for p in parts[1:]]
+            endpoints[target] = {
+                'hotrod': (host, ports[0] if ports else infinispan_ports['hotrod']),
+                'memcached': (host, ports[1] if len(ports) > 1 else infinispan_ports['memcached'])}
+    else:
+        endpoints, tunnels = _open_infinispan_endpoints(_get_inventory_nodes('infinispan'))
+    try:
+        _wait_for_ssh_tunnels(endpoints, tunnels)
+        results = _run_benchmark(endpoints, caches, get_ratio, int(duration), int(workers),
+                                 int(keys), int(value_size))
+    finally:
+        _close_ssh_tunnels(tunnels)
+
+    report = {'started': time.strftime("%Y-%m-%dT%H:%M:%S"), 'workload': workload,
+              'get_ratio': get_ratio, 'duration': int(duration), 'workers': int(workers),
+              'keys': int(keys), 'value_size': int(value_size), 'results': results}
+    baseline = {}
+    if compare:
+        with open(compare, "r") as f:
+            baseline = dict(((r['node'], r['cache']), r) for r in json.load(f)['results'])
+
+    x = PrettyTable(["Node", "Cache", "Protocol", "Ops", "Errors", "Ops/s",
+                     "p50 [ms]", "p99 [ms]", "p999 [ms]", "Ops/s vs baseline"])
+    for r in results:
+        change = ""
+        if (r['node'], r['cache']) in baseline and baseline[(r['node'], r['cache'])]['ops_per_sec']:
+            change = "{0:+.1f}%".format(
+                100.0 * r['ops_per_sec'] / baseline[(r['node'], r['cache'])]['ops_per_sec'] - 100)
+        x.add_row([r['node'], r['cache'], r['protocol'], r['ops'], r['errors'],
+                   "{0:.0f}".format(r['ops_per_sec'])] +
+                  ["{0:.2f}".format(r[p]) if r[p] is not None else "-"
+                   for p in ('p50_ms', 'p99_ms', 'p999_ms')] + [change])
+    print x
+
+    if not os.path.exists(benchmark_results_dir):
+        os.makedirs(benchmark_results_dir)
+    results_file = os.path.join(benchmark_results_dir,
+                                "infinispan-{0}.json".format(time.strftime("%Y%m%d-%H%M%S")))
+    with open(results_file, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results saved to " + results_file
+
+
+def _run_benchmark(endpoints, caches, get_ratio, duration, workers, keys, value_size):
+    """
+    Starts the workers for every node and cache at once, returns the
+    per node and cache totals
+    """
+    queue = multiprocessing.Queue()
+    processes = []
+    for node in sorted(endpoints):
+        for cache in caches:
+            protocol = benchmark_caches.get(cache, 'hotrod')
+            for worker_id in range(0, workers):
+                processes.append(multiprocessing.Process(
+                    target=_benchmark_worker,
+                    args=(queue, (node, cache, protocol), endpoints[node][protocol], worker_id,
+                          workers, get_ratio, duration, keys, value_size)))
+    for p in processes:
+        p.start()
+    # drain the queue before joining, the workers block on big results
+    by_target = {}
+    for i in range(0, len(processes)):
+        target, ops, errors, latencies = queue.get()
+        totals = by_target.setdefault(target, {'ops': 0, 'errors': 0, 'latencies': []})
+        totals['ops'] += ops
+        totals['errors'] += errors
+        totals['latencies'].extend(latencies)
+    for p in processes:
+        p.join()
+
+    results = []
+    for (node, cache, protocol), totals in sorted(by_target.items()):
+        latencies = sorted(totals['latencies'])
+        results.append({'node': node, 'cache': cache, 'protocol': protocol,
+                        'ops': totals['ops'], 'errors': totals['errors'],
+                        'ops_per_sec': totals['ops'] / float(duration),
+                        'p50_ms': _percentile(latencies, 50),
+                        'p99_ms': _percentile(latencies, 99),
+                        'p999_ms': _percentile(latencies, 99.9)})
+    return results
+
+
+def _benchmark_worker(queue, target, address, worker_id, workers, get_ratio, duration, keys, value_size):
+    node, cache, protocol = target
+    client_class = _MemcachedClient if protocol == 'memcached' else _HotRodClient
+    rnd = random.Random(worker_id)
+    value = "x" * value_size
+    ops = 0
+    errors = 0
+    latencies = []
+    client = None
+    try:
+        client = client_class(address, cache)
+        # the worker loads its share of the keys, so the gets find them
+        if get_ratio > 0:
+            for i in range(worker_id, keys, workers):
+                client.put(_benchmark_key(i), value)
+        end = time.time() + duration
+        while time.time() < end:
+            key = _benchmark_key(rnd.randrange(keys))
+            start = time.time()
+            try:
+                if rnd.random() < get_ratio:
+                    client.get(key)
+                else:
+                    client.put(key, value)
+            except (IOError, socket.error):
+                errors += 1
+                client.close()
+                client = client_class(address, cache)
+                continue
+            latencies.append((time.time() - start) * 1000)
+            ops += 1
+    except (IOError, socket.error):
+        errors += 1
+    finally:
+        if client:
+            client.close()
+        queue.put((target, ops, errors, latencies))
+
+
+def _benchmark_key(i):
+    return "leads-benchmark-{0:08d}".format(i)
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+class _HotRodClient(object):
+    """
+    HotRod 2.0 client with basic intelligence, put and get only
+    """
+    def __init__(self, address, cache):
+        self.sock = socket.create_connection(address, timeout=10)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        self.cache = cache
+        self.message_id = 0
+
+    def put(self, key, value):
+        self._request(0x01, _vint(len(key)) + key + _vint(0) + _vint(0) + _vint(len(value)) + value)
+
+    def get(self, key):
+        if self._request(0x03, _vint(len(key)) + key) == 0x00:
+            return self._read(_read_vint(self.reader))
+        return None
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def _request(self, op_code, body):
+        self.message_id += 1
+        # magic, message id, version, op code, cache name, flags, basic intelligence, topology id
+        header = "\xa0" + _vint(self.message_id) + chr(20) + chr(op_code) + \
+                 _vint(len(self.cache)) + self.cache + _vint(0) + "\x01" + _vint(0)
+        self.sock.sendall(header + body)
+        magic = self._read(1)
+        _read_vint(self.reader)
+        op_code, status, topology_changed = [ord(c) for c in self._read(3)]
+        if magic != "\xa1" or topology_changed:
+            raise IOError("Unexpected hotrod response")
+        if status >= 0x81:
+            raise IOError("Hotrod error: " + self._read(_read_vint(self.reader)))
+        return status
+
+    def _read(self, size):
+        data = self.reader.read(size)
+        if len(data) != size:
+            raise IOError("Connection closed")
+        return data
+
+
+def _vint(value):
+    result = ""
+    while value > 0x7f:
+        result += chr((value & 0x7f) | 0x80)
+        value >>= 7
+    return result + chr(value)
+
+
+def _read_vint(reader):
+    value = 0
+    shift = 0
+    while True:
+        b = reader.read(1)
+        if not b:
+            raise IOError("Connection closed")
+        value |= (ord(b) & 0x7f) << shift
+        if not ord(b) & 0x80:
+            return value
+        shift += 7
+
+
+class _MemcachedClient(object):
+    """
+    Memcached text protocol client, the connector serves a single cache
+    """
+    def __init__(self, address, cache):
+        self.sock = socket.create_connection(address, timeout=10)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+
+    def put(self, key, value):
+        self.sock.sendall("set {0} 0 0 {1}\r\n{2}\r\n".format(key, len(value), value))
+        line = self.reader.readline()
+        if line != "STORED\r\n":
+            raise IOError("Memcached error: " + line.strip())
+
+    def get(self, key):
+        self.sock.sendall("get {0}\r\n".format(key))
+        line = self.reader.readline()
+        if line == "END\r\n":
+            return None
+        if not line.startswith("VALUE "):
+            raise IOError("Memcached error: " + line.strip())
+        size = int(line.split()[3])
+        value = self.reader.read(size + 2)[:size]
+        if self.reader.readline() != "END\r\n":
+            raise IOError("Unexpected memcached response")
+        return value
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
 @parallel
 def deploy_additioanl_ssh_keys():
     authorized_file = "~/.ssh/authorized_keys"
@@ -362,19 +2570,48 @@ def deploy_additioanl_ssh_keys():
 
 @roles_host_string_based('masters', 'slaves')
 @parallel
-def install_hadoop():
+def install_hadoop(force=False):
     """
+    Installs only the steps, whose inputs changed since the last run,
+    use install_hadoop:force=true to run all of them
     """
+    _apply_steps(_get_hadoop_package_steps() + _get_hadoop_config_steps(), force)
+
+
+def _get_hadoop_package_steps():
+    if not _has_role('masters', 'slaves'):
+        return []
+    return [('hadoop_package', _get_hadoop_package_fingerprint(), _install_hadoop_package)]
+
+
+def _get_hadoop_config_steps():
+    if not _has_role('masters', 'slaves'):
+        return []
+    hadoop_home = _get_hadoop_home()
+    fingerprint = _fingerprint(_get_hadoop_package_fingerprint(),
+                               _get_hadoop_config_files(hadoop_home))
+    return _get_data_volume_steps() + [('hadoop_config', fingerprint, lambda: _hadoop_configure(hadoop_home)),
+                                       _get_etc_hosts_step()]
+
+
+def _get_hadoop_package_fingerprint():
+    return _fingerprint(hadoop_package_url, _get_stored_artifact_digest(hadoop_package_url))
+
+
+def _has_role(*roles):
+    return any(env.host_string in env.roledefs[r] for r in roles)
+
+
+@roles_host_string_based('masters', 'slaves')
+def _install_hadoop_package():
+    _install_hadoop_artifact()
+
+
+def _install_hadoop_artifact():
     pkg_file_name = _get_hadoop_pkg_name(hadoop_package_url)
     dir_name = _get_hadoop_name(hadoop_package_url)
 
-    if not exists(pkg_file_name):
-        run("wget '{0}' -O {1}".format(hadoop_package_url, pkg_file_name))
-    if not exists(dir_name):
-        run("tar zxvf {0}".format(pkg_file_name))
-
-    hadoop_home = "/home/ubuntu/{0}".format(dir_name)
-    _hadoop_configure(hadoop_home)
+    _install_artifact(hadoop_package_url, pkg_file_name, dir_name)
 
 
 def _get_hadoop_pkg_name(url):
@@ -386,205 +2623,113 @@ def _get_hadoop_name(url):
     return pkg_file_name[:-len('.tar.gz')]
 
 
+@roles_host_string_based('masters', 'slaves')
 def _hadoop_configure(hadoop_home):
-    hadoop_master_priv_ip = get_node_private_ip(hadoop_master_node)
-    _hadoop_heap_configure(hadoop_home)
-    _hadoop_change_map_red_site(hadoop_home, hadoop_master_node)
-    _hadoop_change_core_site(hadoop_home, hadoop_master_priv_ip)
-    _hadoop_change_yarn_site(hadoop_home, hadoop_master_node)
-    _hadoop_change_HDFS_site(hadoop_home, hadoop_master_node)
-    _hadoop_change_masters(hadoop_home, hadoop_master_node)
-    _hadoop_change_slaves(hadoop_home, env.roledefs['slaves'])
-    _hadoop_prepare_etc_host()
+    config_files = _get_hadoop_config_files(hadoop_home)
+    archive = _get_hadoop_config_archive(config_files)
+    _upload_with_scp(archive, archive)
+    _hadoop_swap_config(hadoop_home, archive)
 
 
-def get_node_private_ip(node_name):
-    ns = _find_node_by_name(cluster_name, node_name)
+def _get_hadoop_config_files(hadoop_home):
+    return _render_hadoop_config(hadoop_home, hadoop_master_node,
+                                 get_node_private_ip(hadoop_master_node),
+                                 env.roledefs['slaves'],
+                                 _get_inventory()['by_name'][env.host]['volumes'])
 
-    if not ns:
-        error("No node is running with name {0}!".format(node_name))
-    else:
-        node = ns[0]
-        return node.private_ips[0]
 
-
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_heap_configure(hadoop_home, new_heap_size=1000, old_heap_size=2000):
+def _render_hadoop_config(hadoop_home, master, master_ip, slaves, volumes=()):
     """
-    Le Quoc Do - SE Group TU Dresden contribution
+    Renders etc/hadoop files, returns a dictionary: file name -> content
     """
-    filename = hadoop_home + '/etc/hadoop/hadoop-env.sh'
-    before = 'HADOOP_HEAPSIZE=' + str(new_heap_size)
-    after = 'HADOOP_HEAPSIZE=' + str(old_heap_size)
-    files.sed(filename, before, after, limit='')
-    files.uncomment(filename, 'HADOOP_HEAPSIZE')
-
-
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_change_map_red_site(hadoop_home, master, map_task='8', reduce_task='6'):
-    """
-    Based on input from Le Quoc Do - SE Group TU Dresden contribution
-    """
-    before = '<configuration>'
-    after = """
-<configuration>
-    <property>
-        <name>mapred.job.tracker</name>
-        <value>{0}:9001</value>
-    </property>
-
-    <property>
-        <name>mapred.map.tasks</name>
-        <value>{1}</value>
-    </property>
-
-    <property>
-        <name>mapred.reduce.tasks</name>
-        <value>{2}</value>
-    </property>
-
-    <property>
-        <name>mapred.system.dir</name>
-        <value>{3}/hdfs/mapreduce/system</value>
-    </property>
-
-    <property>
-        <name>mapred.local.dir</name>
-        <value>{3}/hdfs/mapreduce/local</value>
-    </property>
-
-    <property>
-        <name>mapreduce.framework.name</name>
-        <value>yarn</value>
-    </property>
-    """.format(master, map_task, reduce_task,  hadoop_home)
-
-    with cd(hadoop_home + '/etc/hadoop/'):
-        run('cp mapred-site.xml.template mapred-site.xml')
-        filename = 'mapred-site.xml'
-        files.sed(filename, before, after.replace("\n", "\\n"), limit='')
-
-
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_change_core_site(hadoop_home, master_ip):
-    """
-    Based on input from Le Quoc Do - SE Group TU Dresden contribution
-    """
-    content = """
-<configuration>
-    <property>
-        <name>hadoop.tmp.dir</name>
-        <value>{0}/hdfs</value>
-    </property>
-    <property>
-        <name>fs.defaultFS</name>
-        <value>hdfs://{1}:9000</value>
-    </property>
-
-    <property>
-        <name>fs.default.name</name>
-        <value>hdfs://{1}:9000</value>
-    </property>
-
-    <property>
-        <name>mapred.job.tracker</name>
-        <value>{1}:9001</value>
-    </property>
-</configuration>""".format(hadoop_home, master_ip)
-
-    filename = 'core-site.xml'
-    with cd(hadoop_home + '/etc/hadoop/'):
-        run("rm -f {0}; touch {0}".format(filename))
-        files.append(filename, content)
-
-
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_change_yarn_site(hadoop_home, master):
-    filename = 'yarn-site.xml'
+    params = dict(hadoop_config_params)
+    _check_hadoop_memory(_get_hadoop_sizing())
+    for key, value in _get_hadoop_sizing().items():
+        params[key.upper()] = str(value)
+    # the directories are spread over the hdfs volumes, the namenode keeps a copy on each
+    hdfs_mounts = [v['mount'] for v in volumes if v['use'] == 'hdfs']
+    params['DFS_NAME_DIR'] = ",".join("file://{0}/hdfs/name".format(m) for m in hdfs_mounts or [hadoop_home])
+    params['DFS_DATA_DIR'] = ",".join("file://{0}/hdfs/data".format(m) for m in hdfs_mounts or [hadoop_home])
+    params['NODEMANAGER_LOCAL_DIRS'] = ",".join(m + "/yarn/local" for m in hdfs_mounts) or \
+        "${hadoop.tmp.dir}/nm-local-dir"
+    params['HADOOP_HOME'] = hadoop_home
+    params['MASTER'] = master
+    params['MASTER_IP'] = master_ip
+    params['SLAVES'] = "\n".join(slaves)
+
+    config_files = {}
+    for file_name in sorted(os.listdir(hadoop_config_templates_dir)):
+        with open(os.path.join(hadoop_config_templates_dir, file_name), "r") as f:
+            content = f.read()
+        for key, value in params.items():
+            content = content.replace("@" + key + "@", value)
+        config_files[file_name] = content
+    return config_files
+
+
+def _get_hadoop_config_archive(config_files):
+    """
+    Packs the rendered files, the hosts with the same configuration
+    share the archive
+    """
+    archive = "tmp_hadoop_conf_" + _fingerprint(config_files)[:12] + ".tgz"
+    if not os.path.exists(archive):
+        tmp_archive = archive + "." + str(os.getpid())
+        with tarfile.open(tmp_archive, "w:gz") as tar:
+            for file_name, content in sorted(config_files.items()):
+                info = tarfile.TarInfo(file_name)
+                info.size = len(content)
+                info.mtime = time.time()
+                info.mode = 0755 if file_name.endswith(".sh") else 0644
+                tar.addfile(info, StringIO.StringIO(content))
+        os.rename(tmp_archive, archive)
+    return archive
+
+
+def _hadoop_swap_config(hadoop_home, archive):
+    """
+    The rendered files are laid over a copy of the stock etc/hadoop in a
+    new directory, etc/hadoop is a link switched to it in one rename, so
+    the active copy is never touched, even when the version is the same
+    """
+    version = "hadoop." + archive[len("tmp_hadoop_conf_"):-len(".tgz")]
+    with cd(hadoop_home + "/etc"):
+        run("if [ ! -L hadoop ]; then mv hadoop hadoop.dist && ln -s hadoop.dist hadoop; fi && "
+            "new=$(mktemp -d {0}.XXXXXX) && cp -a hadoop.dist/. $new && chmod 755 $new && "
+            "tar xzf ~/{1} -C $new && ln -sfn $new hadoop.next && mv -T hadoop.next hadoop && "
+            "ls -d hadoop.* | grep -v -e '^hadoop.dist$' -e \"^$new$\" | xargs -r rm -rf && "
+            "rm -f ~/{1} && touch ../dfs.exclude ../yarn.exclude".format(version, archive))
 
-    content = """
-<configuration>
-    <property>
-        <name>yarn.nodemanager.aux-services</name>
-        <value>mapreduce_shuffle</value>
-    </property>
-</configuration>"""
 
-    with cd(hadoop_home + '/etc/hadoop/'):
-        run("rm -f {0}; touch {0}".format(filename))
-        files.append(filename, content)
+def get_node_private_ip(node_name):
+    node = _get_inventory()['by_name'].get(node_name)
 
+    if not node:
+        error("No node is running with name {0}!".format(node_name))
+    else:
+        return node['private_ip']
 
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_change_HDFS_site(hadoop_home, master, replica='1', xcieversmax='10096'):
-    """
-    Based on input from Le Quoc Do - SE Group TU Dresden contribution
-    """
-    filename = 'hdfs-site.xml'
-    content = """
-<configuration>
-    <property>
-        <name>dfs.name.dir</name>
-        <value>file://{0}/hdfs/name</value>
-    </property>
-    <property>
-        <name>dfs.data.dir</name>
-        <value>file://{0}/hdfs/data</value>
-    </property>
-
-    <property>
-        <name>dfs.replication</name>
-        <value>{1}</value>
-    </property>
-
-    <property>
-        <name>dfs.datanode.max.xcievers</name>
-        <value>{2}</value>
-    </property>
-</configuration>
-""".format(hadoop_home, replica,  xcieversmax)
-
-    with cd(hadoop_home + '/etc/hadoop/'):
-        run("rm -f {0}; touch {0}".format(filename))
-        files.append(filename, content)
 
+def _get_etc_hosts_step():
+    entries = _get_etc_hosts_entries()
+    return ('etc_hosts', _fingerprint(entries), lambda: _update_etc_hosts(entries))
 
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_change_masters(hadoop_home, master):
-    """
-    Le Quoc Do - SE Group TU Dresden contribution
-    """
-    filename = 'masters'
 
-    with cd(hadoop_home + '/etc/hadoop'):
-        run("rm -f masters; touch masters")
-        files.append(filename, master)
+def _get_etc_hosts_entries():
+    return [n['private_ip'] + " " + n['name'] for n in _get_inventory_nodes()]
 
 
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_change_slaves(hadoop_home, slaves):
+def _update_etc_hosts(entries):
     """
-    Le Quoc Do - SE Group TU Dresden contribution
+    Replaces the cluster block in /etc/hosts in one privileged command,
+    nothing is written, when the block with the same hash is there
     """
-    filename = 'slaves'
-    before = 'localhost'
-    after = ''
-    for slave in slaves:
-        after = after + slave + '\\n'
-    with cd(hadoop_home + '/etc/hadoop'):
-        files.sed(filename, before, after, limit='')
-
-
-@roles_host_string_based('masters', 'slaves')
-def _hadoop_prepare_etc_host():
-    with open('cluster_hosts', 'r') as f:
-        c_hostnames = f.read().split(',')
-    with open('cluster_private_ips', 'r') as f:
-        c_priv_ips = f.read().split(',')
-    for i in range(0, len(c_hostnames)):
-        entry = c_priv_ips[i] + " " + c_hostnames[i]
-        if not files.contains('/etc/hosts', entry):
-            files.append('/etc/hosts', entry, use_sudo=True)
+    begin = "# BEGIN leads-cluster " + cluster_name
+    end = "# END leads-cluster " + cluster_name
+    block = [begin + " " + _fingerprint(entries)[:12]] + entries + [end]
+    sudo("grep -qxF '{0}' /etc/hosts || "
+         "{{ sed -i '/^{1} /,/^{2}$/d' /etc/hosts && printf '%s\\n' {3} >> /etc/hosts; }}".format(
+             block[0], begin, end, " ".join("'" + line + "'" for line in block)))
 
 
 def _get_hadoop_home():
@@ -622,7 +2767,7 @@ def _execute_hadoop_command(cmd):
                    HADOOP_PREFIX=hadoop_home,
                    HADOOP_CONF_DIR=hadoop_home + "/etc/hadoop",
                    HADOOP_YARN_HOME=hadoop_home):
-        run(cmd)
+        return run(cmd)
 
 
 @roles_host_string_based('masters')
@@ -654,6 +2799,98 @@ def stop_hadoop_service():
     _hadoop_command_node_manager("stop")
 
 
+def start_hadoop_cluster():
+    """
+    Starts hadoop services tier by tier, in parallel on all hosts, a tier
+    starts when the services it depends on answer, usage:
+    fab start_hadoop_cluster --ssh-config-path=cluster_ssh_config
+    """
+    _run_hadoop_tiers("start", _get_hadoop_service_tiers(hadoop_services))
+
+
+def stop_hadoop_cluster():
+    """
+    Stops hadoop services in the reverse order of start_hadoop_cluster
+    """
+    _run_hadoop_tiers("stop", list(reversed(_get_hadoop_service_tiers(hadoop_services))))
+
+
+def _get_hadoop_service_tiers(services):
+    """
+    Groups the services, so each one comes after all the services it requires
+    """
+    levels = {}
+
+    def level(service):
+        if service not in levels:
+            levels[service] = 1 + max([level(r) for r in services[service]['requires']] + [-1])
+        return levels[service]
+
+    tiers = [[] for i in range(0, 1 + max(level(s) for s in services))]
+    for service in sorted(services):
+        tiers[levels[service]].append(service)
+    return tiers
+
+
+def _run_hadoop_tiers(action, tiers, hosts=None):
+    x = PrettyTable(["Service", "Host", "Action", "Latency [s]"])
+    for tier in tiers:
+        tier_hosts = []
+        for service in tier:
+            for role in hadoop_services[service]['roles']:
+                tier_hosts.extend(h for h in env.roledefs[role]
+                                  if h not in tier_hosts and (hosts is None or h in hosts))
+        if not tier_hosts:
+            continue
+
+        results = execute(_hadoop_tier_action, tier, action, hosts=tier_hosts)
+
+        failed = []
+        for host in tier_hosts:
+            for service, latency in sorted(results[host].items()):
+                x.add_row([service, host, action, "-" if latency is None else "{0:.1f}".format(latency)])
+                if latency is None:
+                    failed.append(service + "@" + host)
+        if failed:
+            print x
+            error("Not ready after {0} seconds: {1}".format(hadoop_service_timeout_sec, ", ".join(failed)))
+    print x
+
+
+@parallel
+def _hadoop_tier_action(tier, action):
+    """
+    Runs the action for the services of the tier on this host, after start
+    waits until the services answer. Returns service -> latency or None
+    """
+    services = [s for s in tier if _has_role(*hadoop_services[s]['roles'])]
+    start = time.time()
+    for service in services:
+        script = 'hadoop-daemon.sh --config $HADOOP_CONF_DIR --script hdfs' \
+            if service in ('namenode', 'datanode') else 'yarn-daemon.sh --config $HADOOP_CONF_DIR'
+        _execute_hadoop_command('$HADOOP_PREFIX/sbin/{0} {1} {2}'.format(script, action, service))
+
+    latencies = {}
+    for service in services:
+        ready = True
+        if action == "start":
+            port, path = hadoop_services[service]['probe']
+            ready = _wait_for_port(get_node_private_ip(env.host_string), port, path,
+                                   hadoop_service_timeout_sec - (time.time() - start))
+        latencies[service] = time.time() - start if ready else None
+    return latencies
+
+
+def _wait_for_port(ip, port, path, timeout):
+    if path:
+        check = "curl -sf http://{0}:{1}{2} > /dev/null".format(ip, port, path)
+    else:
+        check = "(echo > /dev/tcp/{0}/{1}) 2> /dev/null".format(ip, port)
+    with settings(hide('running'), warn_only=True):
+        result = run("timeout {0} bash -c 'until {1}; do sleep 1; done'".format(max(1, int(timeout)), check))
+    return result.succeeded
+
+
 @roles_host_string_based('masters')
 def hadoop_format():
     hadoop_home = _get_hadoop_home()
@@ -666,16 +2903,452 @@ def hadoop_format():
                 run('bin/hdfs datanode -regular')
 
 
-def show_running_leads_clusters():
+def benchmark_hadoop(tests="dfsio;terasort", dfsio_files=4, dfsio_file_mb=128,
+                     terasort_rows=1000000, compare="last"):
     """
+    Runs TestDFSIO write/read and TeraGen/TeraSort/TeraValidate on the hadoop
+    master, saves the timings and job counters into the result history and
+    compares them with a previous run (compare=last, a file or none)
     """
-    x = PrettyTable(["Cluster name", "Node name", "Node UUID"])
-    for inst in os_conn.list_nodes():
-        md = os_conn.ex_get_metadata(inst)
-        if "leads_cluster_name" in md:
-            row = []
-            row.append(md["leads_cluster_name"])
-            row.append(inst.name)
-            row.append(inst.id)
+    tests = tests.split(";")
+    params = {'tests': tests, 'dfsio_files': int(dfsio_files), 'dfsio_file_mb': int(dfsio_file_mb),
+              'terasort_rows': int(terasort_rows)}
+    baseline = _load_hadoop_benchmark_baseline(compare)
+    if baseline and baseline['params'] != params:
+        warn("The baseline ran with different parameters: {0}".format(baseline['params']))
+    results = execute(_run_hadoop_benchmarks, params, hosts=[hadoop_master_node])[hadoop_master_node]
+
+    config = dict(hadoop_config_params)
+    config.update(_get_hadoop_sizing())
+    report = {'started': time.strftime("%Y-%m-%dT%H:%M:%S"), 'params': params,
+              'config': config, 'results': results}
+
+    x = PrettyTable(["Job", "Metric", "Value", "Baseline", "Change", ""])
+    x.align = "l"
+    for job, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            if metric == 'counters':
+                continue
+            row = [job, metric, value, "", "", ""]
+            previous = baseline.get('results', {}).get(job, {}).get(metric)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and previous:
+                change = 100.0 * value / previous - 100
+                # times and deviations regress when they grow, throughputs when they drop
+                worse = change if re.search("time|deviation", metric) else -change
+                row[3:] = [previous, "{0:+.1f}%".format(change),
+                           "REGRESSION" if worse > hadoop_benchmark_regression_pct else ""]
             x.add_row(row)
     print x
+
+    if not os.path.exists(benchmark_results_dir):
+        os.makedirs(benchmark_results_dir)
+    results_file = os.path.join(benchmark_results_dir,
+                                "hadoop-{0}.json".format(time.strftime("%Y%m%d-%H%M%S")))
+    with open(results_file, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results saved to " + results_file
+
+
+def _load_hadoop_benchmark_baseline(compare):
+    if compare == "none":
+        return {}
+    if compare == "last":
+        history = []
+        if os.path.exists(benchmark_results_dir):
+            history = sorted(f for f in os.listdir(benchmark_results_dir)
+                             if f.startswith("hadoop-") and f.endswith(".json"))
+        if not history:
+            return {}
+        compare = os.path.join(benchmark_results_dir, history[-1])
+    with open(compare, "r") as f:
+        return json.load(f)
+
+
+def _run_hadoop_benchmarks(params):
+    """
+    Returns job -> metrics, the timings, the job counters and the
+    TestDFSIO results
+    """
+    results = {}
+    examples_jar = "$HADOOP_PREFIX/share/hadoop/mapreduce/hadoop-mapreduce-examples-*.jar"
+    tests_jar = "$HADOOP_PREFIX/share/hadoop/mapreduce/hadoop-mapreduce-client-jobclient-*-tests.jar"
+    if 'dfsio' in params['tests']:
+        for mode in ['write', 'read']:
+            output, results['dfsio_' + mode] = _run_hadoop_benchmark_job(
+                "$HADOOP_PREFIX/bin/hadoop jar {0} TestDFSIO -{1} -nrFiles {2} -size {3}MB "
+                "-resFile /tmp/leads-dfsio-{1}.log".format(
+                    tests_jar, mode, params['dfsio_files'], params['dfsio_file_mb']))
+            # e.g. "INFO fs.TestDFSIO:            Throughput mb/sec: 45.3"
+            for name, value in re.findall(r"TestDFSIO:\s+([^:\n]+?):\s+([\d.]+)\s*$", output, re.M):
+                results['dfsio_' + mode][re.sub("[^a-z0-9]+", "_", name.lower())] = float(value)
+        _execute_hadoop_command("$HADOOP_PREFIX/bin/hadoop jar {0} TestDFSIO -clean".format(tests_jar))
+
+    if 'terasort' in params['tests']:
+        _execute_hadoop_command("$HADOOP_PREFIX/bin/hdfs dfs -rm -r -f /benchmarks/tera*")
+        for job, args in [('teragen', "{0} /benchmarks/teragen".format(params['terasort_rows'])),
+                          ('terasort', "/benchmarks/teragen /benchmarks/terasort"),
+                          ('teravalidate', "/benchmarks/terasort /benchmarks/teravalidate")]:
+            output, results[job] = _run_hadoop_benchmark_job(
+                "$HADOOP_PREFIX/bin/hadoop jar {0} {1} {2}".format(examples_jar, job, args))
+        report = _execute_hadoop_command("$HADOOP_PREFIX/bin/hdfs dfs -cat /benchmarks/teravalidate/part-r-*")
+        # teravalidate writes the misordered keys, or only the checksum
+        results['teravalidate']['valid'] = "checksum" in report and "misorder" not in report
+    return results
+
+
+def _run_hadoop_benchmark_job(cmd):
+    start = time.time()
+    with hide('stdout'):
+        output = _execute_hadoop_command(cmd)
+    metrics = {'time_sec': round(time.time() - start, 1), 'counters': _parse_hadoop_counters(output)}
+    return output, metrics
+
+
+def _parse_hadoop_counters(output):
+    """
+    Parses "Counters: N" section of the job client output into name -> value
+    """
+    counters = {}
+    in_counters = False
+    for line in output.splitlines():
+        if re.search(r"Counters: \d+\s*$", line):
+            in_counters = True
+            continue
+        if in_counters:
+            match = re.match(r"^\s+([^=]+)=(\d+)\s*$", line)
+            if match:
+                counters[match.group(1).strip()] = int(match.group(2))
+            elif not line.startswith("\t") and not line.startswith(" "):
+                in_counters = False
+    return counters
+
+
+def show_running_leads_clusters(cluster=None, output="table"):
+    """
+    Shows nodes of the leads clusters, usage:
+    fab show_running_leads_clusters[:cluster=<cluster name>][,output=json]
+    """
+    nodes = _get_running_leads_clusters(_get_os_conn(), cluster)
+    if output == "json":
+        print json.dumps(nodes, indent=2, sort_keys=True)
+    else:
+        x = PrettyTable(["Cluster name", "Node name", "Node UUID"])
+        for n in nodes:
+            x.add_row([n['cluster_name'], n['node_name'], n['node_uuid']])
+        print x
+
+
+def _get_running_leads_clusters(conn, cluster=None, workers=metadata_fetch_workers):
+    all_nodes = conn.list_nodes()
+    metadata = _get_nodes_metadata(conn, all_nodes, workers)
+
+    nodes = []
+    for inst, md in zip(all_nodes, metadata):
+        if "leads_cluster_name" not in md:
+            continue
+        if cluster is not None and md["leads_cluster_name"] != cluster:
+            continue
+        nodes.append({'cluster_name': md["leads_cluster_name"],
+                      'node_name': inst.name,
+                      'node_uuid': inst.id})
+    return nodes
+
+
+def _get_nodes_metadata(conn, nodes, workers):
+    """
+    Takes the metadata from the node listing and fetches it with
+    a bounded pool only for the nodes, where the listing misses it
+    """
+    metadata = [n.extra.get('metadata') for n in nodes]
+    missing = [i for i, md in enumerate(metadata) if md is None]
+    if missing:
+        pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(missing))))
+        try:
+            fetched = pool.map(lambda i: conn.ex_get_metadata(nodes[i]), missing)
+        finally:
+            pool.close()
+            pool.join()
+        for i, md in zip(missing, fetched):
+            metadata[i] = md
+    return metadata
+
+
+class _LatencyDriver(object):
+    """
+    Stand-in for the libcloud driver, each call takes latency_sec
+    """
+    def __init__(self, num_of_nodes, latency_sec, with_listing_metadata):
+        from libcloud.compute.base import Node
+        self.latency_sec = latency_sec
+        self.nodes = []
+        for i in range(0, num_of_nodes):
+            md = {"leads_cluster_name": "cluster-" + str(i % 3)}
+            extra = {'metadata': md} if with_listing_metadata else {'md': md}
+            self.nodes.append(Node(str(i), "node-" + str(i), 0, [], [], self, extra=extra))
+
+    def list_nodes(self):
+        time.sleep(self.latency_sec)
+        return self.nodes
+
+    def ex_get_metadata(self, node):
+        time.sleep(self.latency_sec)
+        return node.extra['md']
+
+
+def benchmark_show_running_leads_clusters(num_of_nodes=200, latency_ms=50):
+    """
+    Compares the metadata fetch strategies against a driver with a simulated per-call latency
+    """
+    num_of_nodes = int(num_of_nodes)
+    latency_sec = int(latency_ms) / 1000.0
+    strategies = [("sequential", False, 1),
+                  ("pool of {0}".format(metadata_fetch_workers), False, metadata_fetch_workers),
+                  ("metadata in listing", True, 1)]
+
+    x = PrettyTable(["Strategy", "Nodes", "Time [s]"])
+    for strategy, with_listing_metadata, workers in strategies:
+        conn = _LatencyDriver(num_of_nodes, latency_sec, with_listing_metadata)
+        start = time.time()
+        nodes = _get_running_leads_clusters(conn, workers=workers)
+        x.add_row([strategy, len(nodes), "{0:.2f}".format(time.time() - start)])
+    print x
+
+
+def measure_startup_time(repeat=5):
+    """
+    Measures how long fab takes to load the fabfile for the common tasks,
+    without the cloud credentials in the environment
+    """
+    common_tasks = ['install_infinispan', 'start_infinispan_service',
+                    'stop_infinispan_service', 'install_hadoop',
+                    'start_hadoop_service', 'stop_hadoop_service']
+    task_env = dict((k, v) for k, v in os.environ.items()
+                    if not k.startswith('OS_') and k != 'LEADS_CLUSTER_NUM_OF_NODES')
+
+    x = PrettyTable(["Task", "Startup time [ms]"])
+    with open(os.devnull, 'w') as devnull:
+        for task in common_tasks:
+            durations = []
+            for i in range(0, int(repeat)):
+                start = time.time()
+                subprocess.check_call(["fab", "-d", task], env=task_env, stdout=devnull)
+                durations.append(time.time() - start)
+            x.add_row([task, "{0:.0f}".format(1000 * sum(durations) / len(durations))])
+    print x
+
+
+def show_trace_summary(file_name=None, top=10):
+    """
+    Prints the critical path and the slowest hosts of a trace
+    recorded with LEADS_CLUSTER_TRACE
+    """
+    events = _load_trace(file_name or trace_file or "trace.json")
+    if not events:
+        error("No spans in the trace")
+    trace_start = min(e['ts'] for e in events)
+    trace_end = max(e['ts'] + e['dur'] for e in events)
+    print "Trace: {0} spans, {1:.1f}s".format(len(events), (trace_end - trace_start) / 1e6)
+
+    path = _get_critical_path(events)
+    x = PrettyTable(["Start [s]", "Duration [s]", "Waited [s]", "Host", "Step", "Span"])
+    x.align = "l"
+    previous_end = trace_start
+    for e in path:
+        x.add_row(["{0:.1f}".format((e['ts'] - trace_start) / 1e6), "{0:.1f}".format(e['dur'] / 1e6),
+                   "{0:.1f}".format(max(0, e['ts'] - previous_end) / 1e6),
+                   e['args'].get('host') or "local", e['args'].get('step', ""), e['name'][:60]])
+        previous_end = e['ts'] + e['dur']
+    print "Critical path ({0:.1f}s in spans):".format(sum(e['dur'] for e in path) / 1e6)
+    print x
+
+    by_host = {}
+    for e in events:
+        by_host.setdefault(e['args'].get('host') or "local", []).append(e)
+    busy = dict((host, _get_busy_time(host_events)) for host, host_events in by_host.items())
+    x = PrettyTable(["Host", "Busy [s]", "Spans", "Slowest span", "Duration [s]"])
+    x.align = "l"
+    for host in sorted(busy, key=busy.get, reverse=True)[:int(top)]:
+        # remote commands and cloud calls first, they are what the helpers wait for
+        slowest = max(by_host[host], key=lambda e: (e['cat'] in ('remote', 'cloud'), e['dur']))
+        x.add_row([host, "{0:.1f}".format(busy[host] / 1e6), len(by_host[host]),
+                   slowest['name'][:60], "{0:.1f}".format(slowest['dur'] / 1e6)])
+    print "Slowest hosts:"
+    print x
+
+
+def _load_trace(file_name):
+    with open(file_name, "r") as f:
+        content = f.read().strip()
+    # the spans are appended, the closing bracket is never written
+    content = content.rstrip(",")
+    if not content.endswith("]"):
+        content += "]"
+    return [e for e in json.loads(content) if e.get('ph') == 'X']
+
+
+def _get_critical_path(events):
+    """
+    Walks back from the end of the trace, taking each time the innermost
+    span that finished last before the one already on the path started
+    """
+    # a span with spans of other threads or forked processes inside it
+    # only waited for them, it is not on the path itself
+    family = {}
+    for e in events:
+        for pid in set([e['pid'], e['args'].get('ppid')]):
+            family.setdefault(pid, []).append(e)
+    for pid in family:
+        family[pid].sort(key=lambda e: e['ts'])
+    family_starts = dict((pid, [e['ts'] for e in family_events])
+                         for pid, family_events in family.items())
+
+    innermost = []
+    for e in events:
+        end = e['ts'] + e['dur']
+        i = bisect.bisect_left(family_starts[e['pid']], e['ts'])
+        has_inner = False
+        for inner in family[e['pid']][i:]:
+            if inner['ts'] >= end:
+                break
+            if (inner['pid'], inner['tid']) != (e['pid'], e['tid']) or \
+                    inner['args']['depth'] > e['args']['depth']:
+                has_inner = True
+                break
+        if not has_inner:
+            innermost.append(e)
+
+    innermost.sort(key=lambda e: e['ts'] + e['dur'])
+    ends = [e['ts'] + e['dur'] for e in innermost]
+    path = []
+    t = ends[-1] if ends else 0
+    while True:
+        i = bisect.bisect_right(ends, t) - 1
+        if i < 0:
+            break
+        path.append(innermost[i])
+        t = innermost[i]['ts'] - 1
+    return list(reversed(path))
+
+
+def _get_busy_time(events):
+    busy = 0
+    busy_until = None
+    for e in sorted(events, key=lambda e: e['ts']):
+        end = e['ts'] + e['dur']
+        if busy_until is None or e['ts'] > busy_until:
+            busy += e['dur']
+            busy_until = end
+        elif end > busy_until:
+            busy += end - busy_until
+            busy_until = end
+    return busy
+
+
+def _enable_tracing():
+    """
+    Wraps the fabfile functions, fabric remote commands and the cloud
+    driver calls into spans written to the trace file
+    """
+    import fabric.operations
+
+    if not os.path.exists(trace_file) or not os.path.getsize(trace_file):
+        with open(trace_file, "w") as f:
+            f.write("[\n")
+
+    module = globals()
+    for name, func in list(module.items()):
+        if not inspect.isfunction(func) or func.__module__ != __name__ or name in untraced_functions:
+            continue
+        if hasattr(func, 'cache'):
+            # memoized, only the first call does the work
+            continue
+        module[name] = _traced(func, name, "helper" if name.startswith("_") else "task")
+
+    get_os_conn = module['_get_os_conn']
+
+    @functools.wraps(get_os_conn)
+    def traced_get_os_conn():
+        return _TracedCloudDriver(get_os_conn())
+    module['_get_os_conn'] = traced_get_os_conn
+
+    run_command = fabric.operations._run_command
+
+    def traced_run_command(command, *args, **kwargs):
+        start = time.time()
+        try:
+            return run_command(command, *args, **kwargs)
+        finally:
+            _write_span(command[:200], "remote", start)
+    fabric.operations._run_command = traced_run_command
+
+
+def _traced(func, name, category):
+    @functools.wraps(func)
+    def func_wrapper(*args, **kwargs):
+        steps = _trace_state.__dict__.setdefault('steps', [])
+        steps.append(name)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            steps.pop()
+            _write_span(name, category, start)
+    return func_wrapper
+
+
+class _TracedCloudDriver(object):
+    """
+    Passes the calls to the libcloud driver, each one in a span
+    """
+    def __init__(self, driver):
+        self._driver = driver
+
+    def __getattr__(self, name):
+        attr = getattr(self._driver, name)
+        if not callable(attr):
+            return attr
+
+        def traced_call(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                _write_span(name, "cloud", start)
+        return traced_call
+
+
+def _write_span(name, category, start):
+    end = time.time()
+    steps = _trace_state.__dict__.get('steps')
+    event = {'name': name, 'cat': category, 'ph': 'X',
+             'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+             'pid': os.getpid(), 'tid': threading.current_thread().ident,
+             'args': {'host': env.host_string, 'step': steps[-1] if steps else None,
+                      'depth': len(steps) if steps else 0, 'ppid': os.getppid()}}
+    # appending keeps the spans of the forked workers, one write per span
+    with open(trace_file, "a") as f:
+        f.write(json.dumps(event) + ",\n")
+
+
+def _limit_gateway_connections():
+    """
+    All the ssh connections of fabric go through the gateway, at most
+    LEADS_CLUSTER_GATEWAY_CONNECTIONS are being set up at a time
+    """
+    import fabric.network
+
+    connect = fabric.network.connect
+
+    def limited_connect(user, host, port, cache, seek_gateway=True):
+        # the connection to env.gateway is set up inside the one to the host
+        if not seek_gateway:
+            return connect(user, host, port, cache, seek_gateway)
+        with resource_slots['gateway']:
+            return connect(user, host, port, cache, seek_gateway)
+    fabric.network.connect = limited_connect
+
+
+_limit_gateway_connections()
+
+if trace_file:
+    _enable_tracing()
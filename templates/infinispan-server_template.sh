@@ -22,6 +22,8 @@ export HOME_UBUNTU_USER="/home/ubuntu/infinispan-server-7.0.1-SNAPSHOT"
 ISPN_SERVER_HOME=${HOME_UBUNTU_USER}
 ISPN_SERVER_CONSOLE_LOG=${ISPN_SERVER_HOME}/standalone/log/console.log
 ISPN_SERVER_CONFIG=infinispan-config.xml
+# JAVA_OPTS sized for the node by the fabfile
+ISPN_SERVER_RUN_CONF=${ISPN_SERVER_HOME}/bin/leads-standalone.conf
 ##
 ##
 
@@ -0,0 +1,232 @@
+import collections
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fabfile
+
+
+class FakeNode(object):
+    def __init__(self, name, extra=None):
+        self.name = name
+        self.id = "id-" + name
+        self.private_ips = ["10.0.0.{0}".format(len(name))]
+        self.extra = extra or {}
+
+
+class FakeImage(object):
+    def __init__(self, name, status):
+        self.name = name
+        self.id = "id-" + name
+        self.extra = {'status': status}
+
+
+class FakeKeyPair(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeDriver(object):
+    """
+    Records the number of calls per method, create_node fails as long as
+    create_failures[name] is positive (after creating the node, if
+    create_despite_failure), get_image returns image_statuses in order
+    """
+
+    def __init__(self, nodes=(), create_failures=None, create_despite_failure=False,
+                 image_statuses=("ACTIVE",)):
+        self.calls = collections.Counter()
+        self.created = []
+        self.nodes = [FakeNode(name) for name in nodes]
+        self.create_failures = dict(create_failures or {})
+        self.create_despite_failure = create_despite_failure
+        self.image_statuses = list(image_statuses)
+        self.destroyed = []
+        self.lock = threading.Lock()
+
+    def _record(self, method):
+        with self.lock:
+            self.calls[method] += 1
+
+    def list_nodes(self):
+        self._record('list_nodes')
+        with self.lock:
+            return list(self.nodes)
+
+    def list_images(self):
+        self._record('list_images')
+        return [FakeImage(fabfile.image_name, "ACTIVE"), FakeImage("other", "ACTIVE")]
+
+    def list_sizes(self):
+        self._record('list_sizes')
+        return [FakeNode(fabfile.node_flavor), FakeNode("other")]
+
+    def get_key_pair(self, name):
+        self._record('get_key_pair')
+        return FakeKeyPair(name)
+
+    def create_node(self, name, **kwargs):
+        self._record('create_node')
+        with self.lock:
+            self.created.append((name, kwargs))
+            failing = self.create_failures.get(name, 0) > 0
+            if failing:
+                self.create_failures[name] -= 1
+            if not failing or self.create_despite_failure:
+                node = FakeNode(name, kwargs.get('ex_metadata'))
+                self.nodes.append(node)
+        if failing:
+            raise Exception("create_node failed")
+        return node
+
+    def wait_until_running(self, nodes, timeout=None, ssh_interface=None):
+        self._record('wait_until_running')
+        return [(n, n.private_ips) for n in nodes]
+
+    def create_image(self, node, name):
+        self._record('create_image')
+        return FakeImage(name, "SAVING")
+
+    def get_image(self, image_id):
+        self._record('get_image')
+        return FakeImage(image_id[len("id-"):], self.image_statuses.pop(0))
+
+    def destroy_node(self, node):
+        self._record('destroy_node')
+        self.destroyed.append(node.name)
+
+
+class PatchedModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = {}
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(fabfile, name, value)
+
+    def patch(self, name, value):
+        self._saved.setdefault(name, getattr(fabfile, name))
+        setattr(fabfile, name, value)
+
+
+class ProvisionNodesTest(PatchedModuleTest):
+
+    def setUp(self):
+        super(ProvisionNodesTest, self).setUp()
+        self.patch('cluster_provisioning_backoff_sec', 0)
+        self.patch('cluster_additinal_ssh_keys', [])
+
+    def provision(self, conn, names, retries=2):
+        return fabfile._provision_nodes(conn, names, [], workers=2, retries=retries,
+                                        image=fabfile.image_name)
+
+    def test_looks_up_once_and_creates_each_node(self):
+        conn = FakeDriver()
+        names = ["node-0", "node-1", "node-2"]
+        nodes = self.provision(conn, names)
+
+        self.assertEqual([n.name for n in nodes], names)
+        self.assertEqual(conn.calls, {'list_nodes': 1, 'list_images': 1, 'list_sizes': 1,
+                                      'get_key_pair': 1, 'create_node': 3})
+
+    def test_skips_the_existing_nodes(self):
+        conn = FakeDriver(nodes=["node-1"])
+        nodes = self.provision(conn, ["node-0", "node-1"])
+
+        self.assertIs(nodes[1], conn.nodes[0])
+        self.assertEqual([name for name, kwargs in conn.created], ["node-0"])
+
+    def test_ignores_duplicates_outside_the_requested_names(self):
+        conn = FakeDriver(nodes=["other", "other"])
+        self.provision(conn, ["node-0"])
+
+        self.assertEqual(conn.calls['create_node'], 1)
+
+    def test_retries_a_failed_create(self):
+        conn = FakeDriver(create_failures={"node-1": 1})
+        nodes = self.provision(conn, ["node-0", "node-1"])
+
+        self.assertEqual([n.name for n in nodes], ["node-0", "node-1"])
+        self.assertEqual(conn.calls['create_node'], 3)
+        # the snapshot and the check before the retry
+        self.assertEqual(conn.calls['list_nodes'], 2)
+
+    def test_does_not_create_twice_when_the_failed_call_created_the_node(self):
+        conn = FakeDriver(create_failures={"node-0": 1}, create_despite_failure=True)
+        nodes = self.provision(conn, ["node-0"])
+
+        self.assertEqual(nodes[0].name, "node-0")
+        self.assertEqual(conn.calls['create_node'], 1)
+
+    def test_gives_up_after_the_retries(self):
+        conn = FakeDriver(create_failures={"node-0": 3})
+
+        self.assertRaises(Exception, self.provision, conn, ["node-0"], 2)
+        self.assertEqual(conn.calls['create_node'], 3)
+
+
+class BakeImageTest(PatchedModuleTest):
+
+    def setUp(self):
+        super(BakeImageTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.patch('cluster_provisioning_backoff_sec', 0)
+        self.patch('cluster_additinal_ssh_keys', [])
+        self.patch('bring_up_poll_interval_sec', 0)
+        self.patch('cluster_image_file', os.path.join(self.tmp_dir, "cluster_image.json"))
+        self.patch('_get_baked_packages', lambda: {'jdk': "fingerprint"})
+        self.prepared = []
+
+    def tearDown(self):
+        super(BakeImageTest, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def prepare_node(self, node_name, ip):
+        self.prepared.append(node_name)
+
+    def bake(self, conn, prepare_node=None):
+        return fabfile._bake_image(conn, "leads-image", [], prepare_node or self.prepare_node, 60)
+
+    def test_waits_until_the_image_is_active(self):
+        conn = FakeDriver(image_statuses=["SAVING", "ACTIVE"])
+        image = self.bake(conn)
+
+        self.assertEqual(image.name, "leads-image")
+        self.assertEqual(self.prepared, [fabfile.cluster_name + "-bake"])
+        self.assertEqual(conn.calls['create_image'], 1)
+        self.assertEqual(conn.calls['get_image'], 2)
+        self.assertEqual(conn.destroyed, [fabfile.cluster_name + "-bake"])
+        with open(fabfile.cluster_image_file) as f:
+            self.assertEqual(json.load(f)['name'], "leads-image")
+
+    def test_bake_node_is_not_tagged_as_cluster_member(self):
+        conn = FakeDriver()
+        self.bake(conn)
+
+        self.assertEqual(conn.created[0][1]['ex_metadata'], {"leads_cluster_bake": fabfile.cluster_name})
+
+    def test_destroys_the_node_when_the_preparation_fails(self):
+        def failing_prepare_node(node_name, ip):
+            raise Exception("apt-get failed")
+        conn = FakeDriver()
+
+        self.assertRaises(Exception, self.bake, conn, failing_prepare_node)
+        self.assertEqual(conn.calls['create_image'], 0)
+        self.assertEqual(conn.destroyed, [fabfile.cluster_name + "-bake"])
+        self.assertFalse(os.path.exists(fabfile.cluster_image_file))
+
+    def test_destroys_the_node_when_the_image_fails(self):
+        conn = FakeDriver(image_statuses=["ERROR"])
+
+        with fabfile.hide('aborts'):
+            self.assertRaises(SystemExit, self.bake, conn)
+        self.assertEqual(conn.destroyed, [fabfile.cluster_name + "-bake"])
+        self.assertFalse(os.path.exists(fabfile.cluster_image_file))
+
+
+if __name__ == '__main__':
+    unittest.main()